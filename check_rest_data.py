@@ -2,7 +2,9 @@
 ################################################################################
 # Name:    check_rest_data.py
 # Purpose: This Python 3 script counts cases from the REST data for a specified
-#          country or all countries.
+#          country or all countries, optionally as of a past UTC time
+#          (--as-of YYYY-MM-DD[THH:MM:SS]) from the history kept by
+#          fetch_data.py in rest_history_dir.
 # Author:  Huidae Cho
 # Since:   March 27, 2020
 #
@@ -24,11 +26,27 @@
 
 import sys
 import json
+import datetime
 
-with open('data/csse_rest.json') as f:
-    features = json.load(f)
+args = sys.argv[1:]
+as_of = None
+if len(args) >= 2 and args[0] in ('-a', '--as-of'):
+    as_of = datetime.datetime.fromisoformat(args[1])
+    if as_of.tzinfo:
+        as_of = as_of.astimezone(datetime.timezone.utc)
+    args = args[2:]
 
-country = sys.argv[1] if len(sys.argv) >= 2 else ''
+if as_of:
+    import fetch_data
+    name, depth, features = fetch_data.read_rest_snapshot(as_of)
+    if features is None:
+        raise Exception(f'No REST snapshot as of {as_of}')
+    print(f'Snapshot {name}', file=sys.stderr)
+else:
+    with open('data/csse_rest.json') as f:
+        features = json.load(f)
+
+country = args[0] if args else ''
 
 confirmed = recovered = deaths = 0
 for feature in features:
@@ -3,3 +3,47 @@ bing_maps_referer = 'BING_MAPS_REFERER'
 app_url = 'APP_URL'
 use_local_data_only = False
 countries_to_display = ()
+parse_processes = None
+country_geodata_json = {
+    'Chile': 'geodata-chile.json',
+    'South Korea': 'geodata-south-korea.json',
+}
+# data sources (csse, kcdc, dxy, statistichecoronavirus, and minsal) and their
+# polling intervals in seconds for fetch_data.py --daemon
+refresh_intervals = {
+    'csse': 3600,
+}
+# interval in seconds for parsing all CSSE daily reports again in --daemon
+# because older reports can be corrected upstream (None to disable)
+daily_refresh_interval = 86400
+compress_outputs = True
+delta_days = 7
+binary_data = False
+derived_metrics = False
+rolling_average_days = 7
+average_days_from_confirmed_to_death = 14
+daily_history_days = None
+checkpoint_dir = 'checkpoints'
+# request timeouts in seconds (connect, read) by data source (csse, csse_rest,
+# bing, kcdc, dxy, statistichecoronavirus, and minsal); default for the others
+http_timeouts = {
+    'default': (10, 60),
+}
+http_retries = 3
+http_backoff = 1
+# data sources and seconds to wait before sending a duplicate request
+hedge_delays = {
+#    'bing': 2,
+}
+columnar_data = False
+validate_data = False
+# repair anomalies found by validate_data: None (report only), carry (keep the
+# maximum so far), or backfill (lower earlier counts to later ones)
+repair_policy = None
+anomaly_jump_factor = 10
+anomaly_jump_minimum = 100
+search_index = False
+# folder for compressed history of REST data (None to disable); a full snapshot
+# is written every rest_history_full_interval snapshots and deltas otherwise
+rest_history_dir = 'rest-history'
+rest_history_full_interval = 30
@@ -0,0 +1,931 @@
+/*******************************************************************************
+ * Name:    covid-19-worker.js
+ * Purpose: This JavaScript file loads geodata.json and aggregates statistics
+ *          in a web worker for covid-19.js so that the map stays responsive.
+ * Author:  Huidae Cho
+ * Since:   April 4, 2020
+ *
+ * Copyright (C) 2020, Huidae Cho <https://idea.isnew.info>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation, either version 3 of the
+ * License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU Affero General Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program.  If not, see <https://www.gnu.org/licenses/>.
+ ******************************************************************************/
+
+// page settings from covid-19.js; see the load message
+let dataUrl;
+let useBinaryData;
+let useDerivedMetrics;
+let useSearchIndex;
+let countryToDisplay;
+let hasDuplicateData;
+let averageDaysFromConfirmedToDeath;
+
+let features;
+let totals;
+let dates;
+let metrics;
+let statsByCountry;
+let sortedByCountry;
+const hashesUrl = 'hashes.json';
+const deltasUrl = 'deltas/';
+const maxDeltaHops = 30;
+
+const timezoneOffset = new Date().getTimezoneOffset() * 60000;
+function getDate(time){
+	return new Date(time * 1000 - timezoneOffset).toISOString().split('T')[0];
+}
+
+function roundCFR(cfrFraction){
+	return Math.round(cfrFraction * 1000) / 10;
+}
+
+function sliceMetrics(m, start){
+	const sliced = {
+		increase: {},
+		average_increase: {},
+		cfr_t: m.cfr_t.slice(start),
+		cfr_ddr: m.cfr_ddr.slice(start)
+	};
+	['confirmed', 'recovered', 'deaths'].forEach(category => {
+		sliced.increase[category] = m.increase[category].slice(start);
+		sliced.average_increase[category] =
+			m.average_increase[category].slice(start);
+	});
+	return sliced;
+}
+
+// add up the series of features on the date axis from the first day to the
+// last day of any of them; counts before the first day of a series are
+// zeros and the last counts of a series that ends early are carried forward;
+// same as add_up_features() in fetch_data.py
+function addUpFeatures(features){
+	let first = dates.length;
+	let last = 0;
+	features.forEach(feature => {
+		const properties = feature.properties;
+		first = Math.min(first, properties.start);
+		last = Math.max(last, properties.start + properties.confirmed.length);
+	});
+	const n = Math.max(last - first, 0);
+	const stats = {time: dates.slice(first, first + n)};
+	['confirmed', 'recovered', 'deaths'].forEach(category => {
+		const counts = stats[category] = new Array(n).fill(0);
+		features.forEach(feature => {
+			const series = feature.properties[category];
+			const start = feature.properties.start - first;
+			for(let i = 0; i < series.length; i++)
+				counts[start + i] += series[i];
+			for(let i = start + series.length; i < n; i++)
+				counts[i] += series[series.length - 1];
+		});
+	});
+	return stats;
+}
+
+function calculateStats(feature, all=false){
+	const featureId = feature.id;
+	const country = feature.properties.country;
+	const province = feature.properties.province;
+	const admin2 = feature.properties.admin2;
+	const confirmed = feature.properties.confirmed;
+	const recovered = feature.properties.recovered;
+	const deaths = feature.properties.deaths;
+
+	const m = metrics ? metrics.features[featureId] : null;
+
+	// skip days before the first case
+	let start = 0;
+	if(!all)
+		while(start < confirmed.length && !confirmed[start] &&
+			  !recovered[start] && !deaths[start])
+			start++;
+
+	return {
+		featureId: featureId,
+		country: country,
+		province: province,
+		admin2: admin2,
+		lastUpdated: feature.properties.lastUpdated,
+		time: dates.slice(feature.properties.start + start,
+			feature.properties.start + confirmed.length),
+		confirmed: confirmed.slice(start),
+		recovered: recovered.slice(start),
+		deaths: deaths.slice(start),
+		metrics: m && m.cfr_t.length == confirmed.length ?
+			sliceMetrics(m, start) : null
+	};
+}
+
+// search index written with search_index = True in config.py or built here;
+// null while it is being loaded
+let searchIndex;
+const searchIndexCallbacks = [];
+
+// same as create_search_index() in fetch_data.py
+function createSearchIndex(){
+	const index = {names: [], levels: [], features: [], trigrams: {}};
+	const entries = {};
+	features.forEach(feature => {
+		const properties = feature.properties;
+		const name = properties.admin2 + ', ' + properties.province + ', ' +
+			properties.country;
+		let entry = entries[name];
+		if(entry === undefined){
+			entry = entries[name] = index.names.length;
+			index.names.push(name);
+			index.levels.push(properties.admin2 ? 2 :
+				properties.province ? 1 : 0);
+			index.features.push([]);
+			const trigrams = new Set();
+			for(let i = 0; i < name.length - 2; i++)
+				trigrams.add(name.substr(i, 3));
+			trigrams.forEach(trigram => {
+				if(!index.trigrams[trigram])
+					index.trigrams[trigram] = [];
+				index.trigrams[trigram].push(entry);
+			});
+		}
+		index.features[entry].push(feature.id);
+	});
+	return index;
+}
+
+function loadSearchIndex(){
+	function setSearchIndex(index){
+		searchIndex = index;
+		searchIndexCallbacks.splice(0).forEach(callback => callback());
+	}
+
+	searchIndex = null;
+	if(useSearchIndex)
+		loadCachedFile(dataUrl.replace(/\.json$/, '-search.json'), 'json',
+			index => {
+				// build it if it is missing or from different data
+				setSearchIndex(index && index.features.reduce(
+					(n, featureIds) => n + featureIds.length, 0) ==
+					features.length ? index : createSearchIndex());
+			});
+	else
+		setSearchIndex(createSearchIndex());
+}
+
+function withSearchIndex(callback){
+	if(searchIndex)
+		callback();
+	else
+		searchIndexCallbacks.push(callback);
+}
+
+// entries of names containing a query; only the names with its rarest trigram
+// are compared
+function searchNames(query){
+	const names = searchIndex.names;
+	let entries = null;
+	for(let i = 0; i < query.length - 2; i++){
+		const found = searchIndex.trigrams[query.substr(i, 3)];
+		if(!found)
+			return [];
+		if(!entries || found.length < entries.length)
+			entries = found;
+	}
+	// queries shorter than a trigram are compared with all the names
+	if(!entries)
+		entries = Array.from(names.keys());
+	return entries.filter(entry => names[entry].indexOf(query) >= 0);
+}
+
+// aggregate the statistics of features matching a query by name; every
+// feature whose "admin2, province, country" name contains the query matches
+function matchQuery(query){
+	const featureIds = [];
+	const coordinates = [];
+	const stats = {
+		time: [],
+		confirmed: [],
+		recovered: [],
+		deaths: []
+	};
+	const matches = [];
+	const matchedFeatures = [];
+	searchNames(query).forEach(entry => {
+		searchIndex.features[entry].forEach(featureId => {
+			matches.push([featureId, searchIndex.levels[entry]]);
+		});
+	});
+	// aggregate series in the order of features
+	matches.sort((a, b) => a[0] - b[0]);
+	const isDuplicateData = hasDuplicateData.indexOf(query) >= 0;
+	const x = query.split(', ');
+	matches.forEach(([featureId, level]) => {
+		const feature = features[featureId];
+		const country = feature.properties.country;
+		const province = feature.properties.province;
+		const admin2 = feature.properties.admin2;
+		if(isDuplicateData){
+			if(query == country){
+				if(!province){
+					const s = calculateStats(feature);
+					stats.lastUpdated = s.lastUpdated;
+					stats.time = s.time;
+					stats.confirmed = s.confirmed;
+					stats.recovered = s.recovered;
+					stats.deaths = s.deaths;
+					stats.metrics = s.metrics;
+				}else
+					featureIds.push(featureId);
+			}
+		}else{
+			const confirmed = feature.properties.confirmed;
+			const recovered = feature.properties.recovered;
+			const deaths = feature.properties.deaths;
+			const n = confirmed.length;
+			if(confirmed[n - 1] + recovered[n - 1] + deaths[n - 1] == 0)
+				return;
+			if(country == 'United States'){
+				// country match
+				let matchLevel = 0;
+				if(admin2 + ', ' + province + ', ' + country == query ||
+				   admin2 == query || (x.length == 3 && admin2 == x[0]))
+					// admin2 match
+					matchLevel = 2;
+				else if(province + ', ' + country == query ||
+					province == query || (x.length == 2 && province == x[0]))
+					// province match
+					matchLevel = 1;
+				// only admin2 records are displayed
+				if(admin2)
+					featureIds.push(featureId);
+				switch(matchLevel){
+				case 0: // country level
+					// find the country data
+					if(level)
+						return;
+					break;
+				case 1: // province level
+					// find the province data
+					if(level == 2 && province != admin2)
+						return;
+					break;
+				}
+				// otherwise, admin2 match and admin2 data
+			}else
+				featureIds.push(featureId);
+			if(!matchedFeatures.length ||
+			   feature.properties.lastUpdated > stats.lastUpdated)
+				stats.lastUpdated = feature.properties.lastUpdated;
+			matchedFeatures.push(feature);
+			coordinates.push(feature.geometry.coordinates);
+		}
+	});
+	if(matchedFeatures.length)
+		Object.assign(stats, addUpFeatures(matchedFeatures));
+	// whole-country queries can use the country metrics precomputed by
+	// fetch_data.py except for the United States whose country-wide record is
+	// used instead of its admin2 records
+	if(metrics && !stats.metrics && query != 'United States' &&
+	   metrics.countries[query] &&
+	   metrics.countries[query].cfr_t.length == stats.time.length)
+		stats.metrics = metrics.countries[query];
+	return {
+		featureIds: featureIds,
+		coordinates: coordinates,
+		stats: stats
+	};
+}
+
+function calculateGlobalStats(){
+	const stats = {
+		lastUpdated: 0,
+		// features listed by province
+		provinces: [],
+		// coordinates of the features in countryToDisplay
+		coordinates: [],
+		maxConfirmedCoor: null,
+		time: [],
+		confirmed: [],
+		recovered: [],
+		deaths: [],
+		confirmedIncrease: [],
+		recoveredIncrease: [],
+		deathsIncrease: [],
+		averageIncrease: null,
+		cfrT: [],
+		cfrDDR: []
+	};
+	const time = stats.time;
+	const confirmedCount = stats.confirmed;
+	const recoveredCount = stats.recovered;
+	const deathsCount = stats.deaths;
+	let maxActive = 0;
+	// features to add up for each country and for global statistics
+	const countryFeatures = {};
+	const totalFeatures = [];
+	statsByCountry = {};
+	sortedByCountry = [];
+	features.forEach(feature => {
+		const featureId = feature.id;
+		const country = feature.properties.country;
+		const province = feature.properties.province;
+		const admin2 = feature.properties.admin2;
+		const confirmed = feature.properties.confirmed;
+		const recovered = feature.properties.recovered;
+		const deaths = feature.properties.deaths;
+		const updated = feature.properties.lastUpdated;
+		const lastIndex = confirmed.length - 1;
+		const lastConfirmed = confirmed[lastIndex];
+		const lastRecovered = recovered[lastIndex];
+		const lastDeaths = deaths[lastIndex];
+
+		if((countryToDisplay && country != countryToDisplay) ||
+		   (!lastConfirmed && !lastRecovered && !lastDeaths))
+			return;
+
+		if((country == 'United States' && admin2) ||
+		   (country != 'United States' &&
+		    (hasDuplicateData.indexOf(country) < 0 || province))){
+			// country statistics
+			stats.provinces.push({
+				featureId: featureId,
+				country: country,
+				province: province,
+				admin2: admin2,
+				confirmed: lastConfirmed,
+				recovered: lastRecovered,
+				deaths: lastDeaths
+			});
+
+			if(updated > stats.lastUpdated)
+				stats.lastUpdated = updated;
+
+			if(countryToDisplay){
+				stats.coordinates.push(feature.geometry.coordinates);
+				const name = province || country;
+
+				// province statistics
+				statsByCountry[name] = {
+					time: dates.slice(feature.properties.start,
+						feature.properties.start + confirmed.length),
+					confirmed: confirmed.slice(),
+					recovered: recovered.slice(),
+					deaths: deaths.slice()
+				};
+			}
+
+			// add up displayed features only so that nothing is counted
+			// twice; same as get_total_features() in fetch_data.py
+			if(!countryToDisplay){
+				// country statistics
+				if(!countryFeatures[country])
+					countryFeatures[country] = [];
+				countryFeatures[country].push(feature);
+			}
+
+			// global statistics; single-country data comes with
+			// precomputed totals
+			if(!totals)
+				totalFeatures.push(feature);
+
+			// find the location with the most active cases among
+			// country-wide records in these countries
+			if(country == 'United States' ||
+			   hasDuplicateData.indexOf(country) >= 0)
+				return;
+		}else if(country == 'United States' && province)
+			return;
+
+		if(updated > stats.lastUpdated)
+			stats.lastUpdated = updated;
+
+		if(lastConfirmed - lastRecovered - lastDeaths > maxActive){
+			maxActive = lastConfirmed - lastRecovered - lastDeaths;
+			stats.maxConfirmedCoor = feature.geometry.coordinates;
+		}
+	});
+	Object.keys(countryFeatures).forEach(country => {
+		statsByCountry[country] = addUpFeatures(countryFeatures[country]);
+	});
+	Object.entries(statsByCountry).forEach(([country, countryStats]) => {
+		const lastIndex = countryStats.confirmed.length - 1;
+		const confirmed = countryStats.confirmed[lastIndex];
+		const recovered = countryStats.recovered[lastIndex];
+		const deaths = countryStats.deaths[lastIndex];
+		sortedByCountry.push({
+			country: country,
+			confirmed: confirmed,
+			recovered: recovered,
+			deaths: deaths,
+			active: confirmed - recovered - deaths,
+			cfrDDR: roundCFR(deaths / (deaths + recovered))
+		});
+	});
+	stats.statsByCountry = statsByCountry;
+
+	if(totals)
+		for(let i = 0; i < totals.time.length; i++){
+			time.push(getDate(totals.time[i]));
+			confirmedCount.push(totals.confirmed[i]);
+			recoveredCount.push(totals.recovered[i]);
+			deathsCount.push(totals.deaths[i]);
+		}
+	else{
+		const totalStats = addUpFeatures(totalFeatures);
+		for(let i = 0; i < totalStats.time.length; i++){
+			time.push(totalStats.time[i]);
+			confirmedCount.push(totalStats.confirmed[i]);
+			recoveredCount.push(totalStats.recovered[i]);
+			deathsCount.push(totalStats.deaths[i]);
+		}
+	}
+
+	// use the metrics precomputed by fetch_data.py if they match
+	const m = !metrics ? null :
+		countryToDisplay && !totals ? metrics.countries[countryToDisplay] :
+		metrics.total;
+	if(m && m.cfr_t.length == time.length){
+		stats.confirmedIncrease = m.increase.confirmed;
+		stats.recoveredIncrease = m.increase.recovered;
+		stats.deathsIncrease = m.increase.deaths;
+		stats.averageIncrease = m.average_increase;
+		stats.cfrT = m.cfr_t;
+		stats.cfrDDR = m.cfr_ddr;
+	}else
+		for(let i = 0; i < time.length; i++){
+			stats.confirmedIncrease.push(confirmedCount[i] -
+				(i > 0 ? confirmedCount[i - 1] : 0));
+			stats.recoveredIncrease.push(recoveredCount[i] -
+				(i > 0 ? recoveredCount[i - 1] : 0));
+			stats.deathsIncrease.push(deathsCount[i] -
+				(i > 0 ? deathsCount[i - 1] : 0));
+			stats.cfrT.push(i >= averageDaysFromConfirmedToDeath ?
+				roundCFR(deathsCount[i] /
+					confirmedCount[i - averageDaysFromConfirmedToDeath]) :
+				null);
+			stats.cfrDDR.push(deathsCount[i] + recoveredCount[i] ?
+				roundCFR(deathsCount[i] /
+					(deathsCount[i] + recoveredCount[i])) : null);
+		}
+
+	return stats;
+}
+
+function sortStatsByCountry(category, sortDescending){
+	let nextCategory;
+	sortedByCountry.sort(function(a, b){
+		switch(category){
+		case 'Confirmed':
+			nextCategory = 'Recovered';
+			a = a.confirmed;
+			b = b.confirmed;
+			break;
+		case 'Recovered':
+			nextCategory = 'Deaths';
+			a = a.recovered;
+			b = b.recovered;
+			break;
+		case 'Deaths':
+			nextCategory = 'Active';
+			a = a.deaths;
+			b = b.deaths;
+			break;
+		case 'Active':
+			nextCategory = 'CFR d/(d+r)';
+			a = a.active;
+			b = b.active;
+			break;
+		case 'CFR d/(d+r)':
+			nextCategory = 'Confirmed';
+			a = a.cfrDDR;
+			b = b.cfrDDR;
+			break;
+		}
+		return sortDescending ? b - a : a - b;
+	});
+	return {
+		nextCategory: nextCategory,
+		sortedByCountry: sortedByCountry
+	};
+}
+
+// convert the time series of each feature to arrays of counts on the times of
+// the longest series; series start on the UTC days of their first points or
+// end on the last day if those days are not found; same as create_time_axis()
+// in fetch_data.py
+function readSeries(data){
+	let time = [];
+	data.features.forEach(feature => {
+		const confirmed = feature.properties.confirmed;
+		if(confirmed.length > time.length)
+			time = confirmed.map(x => x.time);
+	});
+	const index = {};
+	time.forEach((x, i) => {
+		const day = Math.floor(x / 86400);
+		if(!(day in index))
+			index[day] = i;
+	});
+	data.features.forEach(feature => {
+		const properties = feature.properties;
+		const confirmed = properties.confirmed;
+		const n = confirmed.length;
+		let start = index[Math.floor(confirmed[0].time / 86400)];
+		if(start === undefined || start + n > time.length)
+			start = time.length - n;
+		properties.start = start;
+		properties.lastUpdated = confirmed[n - 1].time * 1000;
+		['confirmed', 'recovered', 'deaths'].forEach(category => {
+			properties[category] = properties[category].map(x => x.count);
+		});
+	});
+	// https://stackoverflow.com/a/50130338
+	data.time = time.map(getDate);
+	return data;
+}
+
+// read binary data written with binary_data = True in config.py: a header
+// length, a JSON header, and little-endian Int32 counts by feature, category,
+// and day starting at the index of each feature into the time axis; counts are
+// read through typed array views without copying
+function readBinaryData(buffer){
+	const headerLength = new DataView(buffer).getUint32(0, true);
+	const header = JSON.parse(new TextDecoder().decode(
+		new Uint8Array(buffer, 4, headerLength)));
+	const countsOffset = 4 + headerLength;
+	const data = {
+		type: 'FeatureCollection',
+		features: header.features.map((feature, featureId) => {
+			const n = feature.length;
+			const offset = countsOffset + feature.offset * 4;
+			return {
+				id: featureId,
+				type: 'Feature',
+				geometry: {
+					type: 'Point',
+					coordinates: feature.coordinates
+				},
+				properties: {
+					country: feature.country,
+					province: feature.province,
+					admin2: feature.admin2,
+					lastUpdated: feature.updated * 1000,
+					start: feature.start,
+					confirmed: new Int32Array(buffer, offset, n),
+					recovered: new Int32Array(buffer, offset + n * 4, n),
+					deaths: new Int32Array(buffer, offset + n * 8, n)
+				}
+			};
+		}),
+		time: header.time.map(getDate)
+	};
+	if(header.totals)
+		data.totals = header.totals;
+	return data;
+}
+
+function requestJson(url, callback){
+	const xhr = new XMLHttpRequest();
+	xhr.open('GET', url, true);
+	xhr.responseType = 'json';
+	xhr.onload = function(){
+		callback(xhr.status == 200 ? xhr.response : null, xhr.status);
+	};
+	xhr.onerror = function(){
+		callback(null, xhr.status);
+	};
+	xhr.send();
+}
+
+function applyDelta(data, delta){
+	const oldFeatures = data.features;
+	data.features = delta.features.map((change, featureId) => {
+		let feature;
+		if(change.feature)
+			feature = change.feature;
+		else{
+			feature = oldFeatures[change.from];
+			if(change.geometry)
+				feature.geometry = change.geometry;
+			['confirmed', 'recovered', 'deaths'].forEach(category => {
+				if(!change[category])
+					return;
+				const series = feature.properties[category];
+				series.length = change[category].length;
+				change[category].changes.forEach(([i, time, count]) => {
+					series[i] = {time: time, count: count};
+				});
+			});
+		}
+		feature.id = featureId;
+		return feature;
+	});
+	Object.assign(data, delta.members);
+	return data;
+}
+
+// cache data from the last visit in IndexedDB by url with its version from
+// hashes.json; structured cloning stores objects and array buffers as is
+const cacheDbName = 'covid-19';
+const cacheStoreName = 'data';
+let cacheDb;
+function openCache(callback){
+	if(cacheDb !== undefined){
+		callback(cacheDb);
+		return;
+	}
+	try{
+		const request = indexedDB.open(cacheDbName, 1);
+		request.onupgradeneeded = function(){
+			request.result.createObjectStore(cacheStoreName);
+		};
+		request.onsuccess = function(){
+			cacheDb = request.result;
+			callback(cacheDb);
+		};
+		request.onerror = function(){
+			// IndexedDB is not available in some private browsing modes
+			cacheDb = null;
+			callback(cacheDb);
+		};
+	}catch(e){
+		cacheDb = null;
+		callback(cacheDb);
+	}
+}
+
+function readCache(url, callback){
+	openCache(db => {
+		if(!db){
+			callback(null);
+			return;
+		}
+		const request = db.transaction(cacheStoreName).
+			objectStore(cacheStoreName).get(url);
+		request.onsuccess = function(){
+			callback(request.result || null);
+		};
+		request.onerror = function(){
+			callback(null);
+		};
+	});
+}
+
+function cacheData(url, version, data){
+	openCache(db => {
+		if(!db)
+			return;
+		try{
+			// put() clones data now, so the caller can modify it afterwards
+			db.transaction(cacheStoreName, 'readwrite').
+				objectStore(cacheStoreName).put({
+					version: version,
+					data: data
+				}, url);
+		}catch(e){
+			// most likely, the data is too big for the storage quota
+		}
+	});
+}
+
+// load the data cached from the last visit and apply deltas to bring it up to
+// the current version; download the full data only if there is no cached data
+// or deltas are missing
+function loadData(callback, url=dataUrl){
+	readCache(url, cached => {
+		requestJson(hashesUrl + '?' + Date.now(), hashes => {
+			const version = hashes ? hashes[url] : null;
+
+			function loadFullData(){
+				requestJson(url + (version ? '?' + version : ''),
+					(data, status) => {
+						if(data && version)
+							cacheData(url, version, data);
+						callback(data, status);
+					});
+			}
+
+			function updateData(data, dataVersion, hops){
+				if(dataVersion == version){
+					if(hops)
+						cacheData(url, version, data);
+					callback(data, 200);
+				}else if(hops >= maxDeltaHops)
+					loadFullData();
+				else
+					requestJson(deltasUrl + dataVersion + '.json', delta => {
+						if(delta && delta.base == dataVersion)
+							updateData(applyDelta(data, delta), delta.version,
+								hops + 1);
+						else
+							loadFullData();
+					});
+			}
+
+			if(cached && version)
+				updateData(cached.data, cached.version, 0);
+			else
+				loadFullData();
+		});
+	});
+}
+
+// binary data and metrics have no deltas; use the cached copy only if its
+// version is current
+function loadCachedFile(url, responseType, callback){
+	readCache(url, cached => {
+		requestJson(hashesUrl + '?' + Date.now(), hashes => {
+			const version = hashes ? hashes[url] : null;
+			if(cached && version && cached.version == version){
+				callback(cached.data, 200);
+				return;
+			}
+			const xhr = new XMLHttpRequest();
+			xhr.open('GET', url + (version ? '?' + version : ''), true);
+			xhr.responseType = responseType;
+			xhr.onload = function(){
+				const status = xhr.status;
+				const data = status == 200 ? xhr.response : null;
+				if(data && version)
+					cacheData(url, version, data);
+				callback(data, status);
+			};
+			xhr.onerror = function(){
+				callback(null, xhr.status);
+			};
+			xhr.send();
+		});
+	});
+}
+
+function loadBinaryData(callback){
+	const binaryDataUrl = dataUrl.replace(/\.json$/, '.bin');
+	loadCachedFile(binaryDataUrl, 'arraybuffer', (buffer, status) => {
+		callback(buffer ? readBinaryData(buffer) : null, status);
+	});
+}
+
+// derived metrics written with derived_metrics = True in config.py
+function loadMetrics(callback){
+	const metricsUrl = dataUrl.replace(/\.json$/, '-metrics.json');
+	loadCachedFile(metricsUrl, 'json', callback);
+}
+
+// radii before scaling by zoom level and device, and the opacity of active
+// cases, calculated once per feature; see createStyle() in covid-19.js
+function calculateStyleAttributes(confirmed, recovered, deaths){
+	const radius = 3 * Math.log10(confirmed + 1);
+	const minOpacity = 0.05;
+	const maxOpacity = 0.4;
+	return {
+		radius: radius,
+		recoveredRadius: Math.sqrt((recovered + deaths) / confirmed) * radius,
+		deathsRadius: Math.sqrt(deaths / confirmed) * radius,
+		opacity: minOpacity + (maxOpacity - minOpacity) *
+			(confirmed - recovered - deaths) / confirmed
+	};
+}
+
+// post only what the map needs for styling and selecting features; series stay
+// here for statistics
+function postData(){
+	postMessage({
+		type: 'data',
+		data: {
+			type: 'FeatureCollection',
+			features: features.map(feature => {
+				const properties = feature.properties;
+				const lastIndex = properties.confirmed.length - 1;
+				const confirmed = properties.confirmed[lastIndex];
+				const recovered = properties.recovered[lastIndex];
+				const deaths = properties.deaths[lastIndex];
+				return {
+					id: feature.id,
+					type: 'Feature',
+					geometry: feature.geometry,
+					properties: Object.assign({
+						country: properties.country,
+						province: properties.province,
+						admin2: properties.admin2,
+						confirmed: confirmed,
+						recovered: recovered,
+						deaths: deaths
+					}, calculateStyleAttributes(confirmed, recovered, deaths))
+				};
+			})
+		},
+		stats: calculateGlobalStats(),
+		rollingAverageDays: metrics ? metrics.rolling_average_days : null
+	});
+}
+
+// data downsampled by daily_history_days in config.py has its full history in
+// another file, which is loaded only when statistics need days before the daily
+// history
+let fullDataUrl = null;
+let dailyStartDate = null;
+const fullDataCallbacks = [];
+
+function loadFullData(){
+	loadData(data => {
+		// keep the downsampled data if the full history is not available
+		if(data){
+			readSeries(data);
+			features = data.features;
+			dates = data.time;
+			totals = data.totals;
+		}
+		fullDataUrl = null;
+		fullDataCallbacks.splice(0).forEach(callback => callback());
+	}, fullDataUrl);
+}
+
+// calculate the result of a request again with the full history if it needs
+// days before the daily history
+function withFullData(calculate, getTime, callback){
+	const result = calculate();
+	const time = getTime(result);
+	if(!fullDataUrl || !time.length || time[0] >= dailyStartDate){
+		callback(result);
+		return;
+	}
+	fullDataCallbacks.push(() => callback(calculate()));
+	if(fullDataCallbacks.length == 1)
+		loadFullData();
+}
+
+function load(){
+	(useBinaryData ? loadBinaryData : loadData)((data, status) => {
+		if(!data){
+			postMessage({type: 'error', status: status});
+			return;
+		}
+		if(!useBinaryData)
+			readSeries(data);
+		features = data.features;
+		dates = data.time;
+		totals = data.totals;
+		if(data.full){
+			fullDataUrl = data.full;
+			dailyStartDate = getDate(data.daily_start);
+		}
+
+		function populate(){
+			postData();
+			loadSearchIndex();
+		}
+
+		if(useDerivedMetrics)
+			loadMetrics(m => {
+				metrics = m;
+				populate();
+			});
+		else
+			populate();
+	});
+}
+
+onmessage = function(e){
+	const message = e.data;
+	switch(message.type){
+	case 'load':
+		dataUrl = message.dataUrl;
+		useBinaryData = message.useBinaryData;
+		useDerivedMetrics = message.useDerivedMetrics;
+		useSearchIndex = message.useSearchIndex;
+		countryToDisplay = message.countryToDisplay;
+		hasDuplicateData = message.hasDuplicateData;
+		averageDaysFromConfirmedToDeath =
+			message.averageDaysFromConfirmedToDeath;
+		load();
+		break;
+	case 'stats':
+		withFullData(() => calculateStats(features[message.featureId]),
+			result => result.time, result => {
+				postMessage({id: message.id, result: result});
+			});
+		break;
+	case 'query':
+		withSearchIndex(() => {
+			withFullData(() => matchQuery(message.query),
+				result => result.stats.time, result => {
+					postMessage({id: message.id, result: result});
+				});
+		});
+		break;
+	case 'sort':
+		postMessage({
+			id: message.id,
+			result: sortStatsByCountry(message.category,
+				message.sortDescending)
+		});
+		break;
+	}
+};
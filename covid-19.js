@@ -54,73 +54,66 @@ function getColor(category, opacity=null){
 	return color;
 }
 
-function calculateConfirmedRadius(confirmed){
-	return 3 * Math.log10(confirmed + 1) * (isMobile ? 0.5 : 1);
+function scaleRadius(radius){
+	return radius * (isMobile ? 0.5 : 1);
+}
+
+function isFeatureDisplayed(country, province, admin2){
+	return !((countryToDisplay && country != countryToDisplay) ||
+		 (country == 'United States' && !admin2) ||
+		 (country != 'United States' &&
+		  hasDuplicateData.indexOf(country) >= 0 && !province));
+}
+
+// circle styles shared by features with the same quantized radius and opacity
+// instead of creating new styles for every feature on every render
+const circleStyles = {};
+function getCircleStyle(category, radius, opacity, hasStroke){
+	radius = Math.round(radius * 2) / 2;
+	opacity = Math.round(opacity * 100) / 100;
+	const key = [category, radius, opacity, hasStroke].join();
+	let style = circleStyles[key];
+	if(!style)
+		style = circleStyles[key] = new ol.style.Style({
+			image: new ol.style.Circle({
+				radius: radius,
+				fill: new ol.style.Fill({
+					color: getColor(category,
+						category == 'deaths' ? 2 * opacity : opacity)
+				}),
+				stroke: hasStroke ? new ol.style.Stroke({
+					color: 'rgba(85, 85, 85, ' + 2 * opacity + ')'
+				}) : null
+			})
+		});
+	return style;
 }
 
 function createStyle(feature, resolution){
 	const radiusFactor = Math.log10(maxResolution / resolution) * 0.5 + 1;
-	const country = feature.get('country');
-	const province = feature.get('province');
-	const admin2 = feature.get('admin2');
-
-	if((countryToDisplay && country != countryToDisplay) ||
-	   (country == 'United States' && !admin2) ||
-	   (country != 'United States' &&
-	    hasDuplicateData.indexOf(country) >= 0 && !province))
-		return null;
 
-	const lastIndex = feature.get('confirmed').length - 1;
-	const confirmed = feature.get('confirmed')[lastIndex].count;
-	const recovered = feature.get('recovered')[lastIndex].count;
-	const deaths = feature.get('deaths')[lastIndex].count;
+	// the last counts and style attributes of features posted by
+	// covid-19-worker.js
+	const confirmed = feature.get('confirmed');
+	const recovered = feature.get('recovered');
+	const deaths = feature.get('deaths');
+	const radius = scaleRadius(feature.get('radius')) * radiusFactor;
 
 	let style;
 	if(true){
-		const confirmedRadius = calculateConfirmedRadius(confirmed) *
-			radiusFactor;
-		const recoveredRadius = Math.sqrt((recovered + deaths) / confirmed) *
-			confirmedRadius;
-		const deathsRadius = Math.sqrt(deaths / confirmed) * confirmedRadius;
-		const minOpacity = 0.05;
-		const maxOpacity = 0.4;
-		const opacity = minOpacity + (maxOpacity - minOpacity) *
-			(confirmed - recovered - deaths) / confirmed;
-		const stroke = resolution > 4000 ? null : new ol.style.Stroke({
-			color: 'rgba(85, 85, 85, ' + 2 * opacity + ')'
-		});
+		const opacity = feature.get('opacity');
+		const hasStroke = resolution <= 4000;
 		style = [
-			new ol.style.Style({
-				image: new ol.style.Circle({
-					radius: confirmedRadius,
-					fill: new ol.style.Fill({
-						color: getColor('confirmed', opacity)
-					}),
-					stroke: stroke
-				})
-			}),
-			new ol.style.Style({
-				image: new ol.style.Circle({
-					radius: recoveredRadius,
-					fill: new ol.style.Fill({
-						color: getColor('recovered', opacity)
-					}),
-					stroke: stroke
-				})
-			}),
-			new ol.style.Style({
-				image: new ol.style.Circle({
-					radius: deathsRadius,
-					fill: new ol.style.Fill({
-						color: getColor('deaths', 2 * opacity)
-					}),
-					stroke: stroke
-				})
-			})
+			getCircleStyle('confirmed', radius, opacity, hasStroke),
+			getCircleStyle('recovered',
+				scaleRadius(feature.get('recoveredRadius')) * radiusFactor,
+				opacity, hasStroke),
+			getCircleStyle('deaths',
+				scaleRadius(feature.get('deathsRadius')) * radiusFactor,
+				opacity, hasStroke)
 		];
 	}else{
 		const data = [recovered, confirmed - recovered - deaths, deaths];
-		const radius = calculateConfirmedRadius(confirmed) * radiusFactor;
 		style = new ol.style.Style({
 			image: new ol.style.Chart({
 				type: 'pie',
@@ -138,6 +131,34 @@ function createStyle(feature, resolution){
 	return style;
 }
 
+// WebGL layers for confirmed, recovered, and deaths circles that draw many
+// features faster than the canvas; sizes and opacities are read from the style
+// attributes of features on the GPU
+function createWebGLPointsLayers(source){
+	// radiusFactor in createStyle() by zoom level; maxResolution is at the
+	// initial zoom, not the current one when these layers are created
+	const radiusFactor = ['+', ['*',
+		['-', ['zoom'], view.getZoomForResolution(maxResolution)],
+		Math.log10(2) * 0.5], 1];
+	return [
+		['confirmed', 'radius', 1],
+		['recovered', 'recoveredRadius', 1],
+		['deaths', 'deathsRadius', 2]
+	].map(([category, radius, opacityFactor]) =>
+		new ol.layer.WebGLPoints({
+			source: source,
+			style: {
+				symbol: {
+					symbolType: 'circle',
+					size: ['*', ['get', radius], radiusFactor,
+						scaleRadius(2)],
+					color: ol.color.asArray(getColor(category)),
+					opacity: ['*', ['get', 'opacity'], opacityFactor]
+				}
+			}
+		}));
+}
+
 function createLinks(country, province, admin2, featureId, isPopup){
 	const admin2Query = admin2 ?
 		admin2 + ', ' + province + ', ' + country : null;
@@ -182,49 +203,39 @@ function highlightProvinceStats(featureIds){
 	});
 }
 
-const timezoneOffset = new Date().getTimezoneOffset() * 60000;
-function getDate(time){
-	return new Date(time * 1000 - timezoneOffset).toISOString().split('T')[0];
+function sliceMetrics(m, start){
+	const sliced = {
+		increase: {},
+		average_increase: {},
+		cfr_t: m.cfr_t.slice(start),
+		cfr_ddr: m.cfr_ddr.slice(start)
+	};
+	['confirmed', 'recovered', 'deaths'].forEach(category => {
+		sliced.increase[category] = m.increase[category].slice(start);
+		sliced.average_increase[category] =
+			m.average_increase[category].slice(start);
+	});
+	return sliced;
 }
 
-function calculateStats(feature, all=false){
-	const featureId = feature.id;
-	const country = feature.properties.country;
-	const province = feature.properties.province;
-	const admin2 = feature.properties.admin2;
-	const confirmed = feature.properties.confirmed;
-	const recovered = feature.properties.recovered;
-	const deaths = feature.properties.deaths;
-
-	const time = [];
-	const confirmedCount = [];
-	const recoveredCount = [];
-	const deathsCount = [];
-
-	for(let i = 0; i <= confirmed.length - 1; i++){
-		const c = confirmed[i].count;
-		const r = recovered[i].count;
-		const d = deaths[i].count;
-		if(all || time.length || c || r || d){
-			// https://stackoverflow.com/a/50130338
-			time.push(getDate(confirmed[i].time));
-			confirmedCount.push(c);
-			recoveredCount.push(r);
-			deathsCount.push(d);
-		}
-	}
-
-	return {
-		featureId: featureId,
-		country: country,
-		province: province,
-		admin2: admin2,
-		lastUpdated: confirmed[confirmed.length-1].time * 1000,
-		time: time,
-		confirmed: confirmedCount,
-		recovered: recoveredCount,
-		deaths: deathsCount
-	};
+// dotted lines for the rolling averages of daily increases precomputed by
+// fetch_data.py
+function addAverageIncreaseTrends(trends, x, averageIncrease){
+	if(!averageIncrease)
+		return;
+	trends.slice().forEach(trend => {
+		const category = trend.name.toLowerCase();
+		trends.push({
+			name: trend.name + ' (' + rollingAverageDays + '-day average)',
+			x: x,
+			y: averageIncrease[category],
+			mode: 'lines',
+			line: {
+				color: getColor(category),
+				dash: 'dot'
+			}
+		});
+	});
 }
 
 function roundCFR(cfrFraction){
@@ -305,25 +316,40 @@ function showPopup(stats, coor){
 	// data; these stats have undefined featureId
 	popup.show(coor, content);
 
-	const confirmedIncrease = [];
-	const recoveredIncrease = [];
-	const deathsIncrease = [];
-	const cfrT = [];
+	const m = stats.metrics;
+	let confirmedIncrease = [];
+	let recoveredIncrease = [];
+	let deathsIncrease = [];
+	let averageIncrease = null;
+	let cfrT = [];
 	// United States doesn't have recovered at a province or admin2 level
-	const cfrDDR = lastCFRddr == null ? null : [];
-
-	for(let i = start; i < time.length; i++){
-		confirmedIncrease.push(confirmedCount[i] -
-			(i > 0 ? confirmedCount[i - 1] : 0));
-		recoveredIncrease.push(recoveredCount[i] -
-			(i > 0 ? recoveredCount[i - 1] : 0));
-		deathsIncrease.push(deathsCount[i] - (i > 0 ? deathsCount[i - 1] : 0));
-		cfrT.push(i >= start + T ?
-			roundCFR(deathsCount[i] / confirmedCount[i - T]) : null);
+	let cfrDDR = lastCFRddr == null ? null : [];
+
+	if(m){
+		// use the metrics precomputed by fetch_data.py
+		const sliced = sliceMetrics(m, start);
+		confirmedIncrease = sliced.increase.confirmed;
+		recoveredIncrease = sliced.increase.recovered;
+		deathsIncrease = sliced.increase.deaths;
+		averageIncrease = sliced.average_increase;
+		cfrT = sliced.cfr_t;
 		if(cfrDDR)
-			cfrDDR.push(deathsCount[i] + recoveredCount[i] ?
-				roundCFR(deathsCount[i] / (deathsCount[i] + recoveredCount[i]))
-				: null);
+			cfrDDR = sliced.cfr_ddr;
+	}else{
+		for(let i = start; i < time.length; i++){
+			confirmedIncrease.push(confirmedCount[i] -
+				(i > 0 ? confirmedCount[i - 1] : 0));
+			recoveredIncrease.push(recoveredCount[i] -
+				(i > 0 ? recoveredCount[i - 1] : 0));
+			deathsIncrease.push(deathsCount[i] -
+				(i > 0 ? deathsCount[i - 1] : 0));
+			cfrT.push(i >= start + T ?
+				roundCFR(deathsCount[i] / confirmedCount[i - T]) : null);
+			if(cfrDDR)
+				cfrDDR.push(deathsCount[i] + recoveredCount[i] ?
+					roundCFR(deathsCount[i] /
+						(deathsCount[i] + recoveredCount[i])) : null);
+		}
 	}
 
 	const popupStatsEl = document.getElementById('popup-stats');
@@ -408,6 +434,7 @@ function showPopup(stats, coor){
 					color: getColor('deaths')
 				}
 			});
+		addAverageIncreaseTrends(trends, time.slice(start), averageIncrease);
 		const layout = {
 			yaxis: {
 				type: plotType == 1 ? 'linear' : 'log'
@@ -481,8 +508,9 @@ function zoomToExtent(extent){
 
 function showFeatureStatsAtCoordinates(feature, coor){
 	highlightProvinceStats([feature.id]);
-	const stats = calculateStats(feature);
-	showPopup(stats, coor);
+	requestWorker({type: 'stats', featureId: feature.id}, stats => {
+		showPopup(stats, coor);
+	});
 }
 
 function showFeatureStatsById(featureId){
@@ -493,14 +521,6 @@ function showFeatureStatsById(featureId){
 }
 
 function showFeatureStatsByQuery(query){
-	const extent = new ol.extent.createEmpty();
-	const featureIds = [];
-	const stats = {
-		time: [],
-		confirmed: [],
-		recovered: [],
-		deaths: []
-	};
 	let featureId = Number(query);
 	if(!isNaN(featureId) && Number.isInteger(featureId)){
 		if(featureId > 0)
@@ -509,90 +529,26 @@ function showFeatureStatsByQuery(query){
 			featureId = features.length + featureId;
 
 		const feature = features[featureId];
-		if(feature && document.getElementById('feature-' + featureId)){
-			const coor = ol.proj.fromLonLat(feature.geometry.coordinates);
-			ol.extent.extend(extent, [coor[0], coor[1], coor[0], coor[1]]);
-			featureIds.push(featureId);
-		}
+		showQueryResult(query,
+			feature && document.getElementById('feature-' + featureId) ? {
+				featureIds: [featureId],
+				coordinates: [feature.geometry.coordinates],
+				stats: null
+			} : {featureIds: [], coordinates: [], stats: null});
 	}else
-		features.forEach(feature => {
-			const featureId = feature.id;
-			const country = feature.properties.country;
-			const province = feature.properties.province;
-			const admin2 = feature.properties.admin2;
-			const admin2Query = admin2 + ', ' + province + ', ' + country;
-			const provinceQuery = province + ', ' + country;
-			const coor = ol.proj.fromLonLat(feature.geometry.coordinates);
-			if(hasDuplicateData.indexOf(query) >= 0){
-				if(query == country){
-					if(!province){
-						const s = calculateStats(feature);
-						stats.lastUpdated = s.lastUpdated;
-						stats.time = s.time;
-						stats.confirmed = s.confirmed;
-						stats.recovered = s.recovered;
-						stats.deaths = s.deaths;
-					}else
-						featureIds.push(featureId);
-				}
-			}else if(admin2Query == query || admin2Query.indexOf(query) >= 0 ||
-				 provinceQuery == query || provinceQuery.indexOf(query) >= 0 ||
-				 (query != 'Others' && province.indexOf(query) >= 0) ||
-				 country.indexOf(query) >= 0){
-				const s = calculateStats(feature, true);
-				if(s.confirmed[s.confirmed.length - 1] +
-				   s.recovered[s.recovered.length - 1] +
-				   s.deaths[s.deaths.length - 1] == 0)
-					return;
-				if(country == 'United States'){
-					// country match
-					let matchLevel = 0;
-					const x = query.split(', ');
-					if(admin2Query == query || admin2 == query ||
-					   (x.length == 3 && admin2 == x[0]))
-						// admin2 match
-						matchLevel = 2;
-					else if(provinceQuery == query || province == query ||
-						(x.length == 2 && province == x[0]))
-						// province match
-						matchLevel = 1;
-					// only admin2 records are displayed
-					if(admin2)
-						featureIds.push(featureId);
-					switch(matchLevel){
-					case 0: // country level
-						// find the country data
-						if(province || admin2)
-							return;
-						break;
-					case 1: // province level
-						// find the province data
-						if(province != admin2 && admin2)
-							return;
-						break;
-					}
-					// otherwise, admin2 match and admin2 data
-				}else
-					featureIds.push(featureId);
-				if(stats.time.length == 0){
-					stats.lastUpdated = s.lastUpdated;
-					stats.time = s.time;
-					stats.confirmed = s.confirmed;
-					stats.recovered = s.recovered;
-					stats.deaths = s.deaths;
-				}else{
-					if(s.lastUpdated > stats.lastUpdated)
-						stats.lastUpdated = s.lastUpdated;
-					for(let i = stats.time.length - 1, j = s.time.length - 1;
-						i >= 0 && j >= 0; i--, j--){
-						stats.confirmed[i] += s.confirmed[j];
-						stats.recovered[i] += s.recovered[j];
-						stats.deaths[i] += s.deaths[j];
-					}
-				}
-				ol.extent.extend(extent, [coor[0], coor[1], coor[0], coor[1]]);
-			}
+		requestWorker({type: 'query', query: query}, result => {
+			showQueryResult(query, result);
 		});
+}
+
+function showQueryResult(query, result){
+	const extent = new ol.extent.createEmpty();
+	const featureIds = result.featureIds;
+	const stats = result.stats;
+	result.coordinates.forEach(coordinates => {
+		const coor = ol.proj.fromLonLat(coordinates);
+		ol.extent.extend(extent, [coor[0], coor[1], coor[0], coor[1]]);
+	});
 	if(featureIds.length){
 		window.location.hash = 'feature-' + featureIds[0];
 		highlightProvinceStats(featureIds);
@@ -714,6 +670,7 @@ function plotIncrease(){
 			color: getColor('deaths')
 		}
 	});
+	addAverageIncreaseTrends(trends, time, averageIncrease);
 	const layout = {
 		yaxis: {
 			type: plotType == 1 ? 'linear' : 'log'
@@ -922,178 +879,57 @@ function generatePlotsMenu(menuEl, menuConfig){
 	});
 }
 
-const statsByCountry = {};
-const time = [];
-const confirmedCount = [];
-const recoveredCount = [];
-const deathsCount = [];
-const confirmedIncrease = [];
-const recoveredIncrease = [];
-const deathsIncrease = [];
-const cfrT = [];
-const cfrDDR = [];
-function showGlobalStats(panToMaxConfirmed){
-	let lastUpdated = 0;
+// global statistics calculated by covid-19-worker.js
+let statsByCountry = {};
+let time = [];
+let confirmedCount = [];
+let recoveredCount = [];
+let deathsCount = [];
+let confirmedIncrease = [];
+let recoveredIncrease = [];
+let deathsIncrease = [];
+let cfrT = [];
+let cfrDDR = [];
+let averageIncrease = null;
+function showGlobalStats(stats, panToMaxConfirmed){
+	const lastUpdated = stats.lastUpdated;
 	let statsByProvince = '';
-	let maxActive = 0;
-	let maxConfirmedCoor;
-	const extent = countryToDisplay ? new ol.extent.createEmpty() : null;
-	features.forEach(feature => {
-		const featureId = feature.id;
-		const country = feature.properties.country;
-		const province = feature.properties.province;
-		const admin2 = feature.properties.admin2;
-		const latitude = feature.geometry.coordinates[1];
-		const longitude = feature.geometry.coordinates[0];
-		const confirmed = feature.properties.confirmed;
-		const recovered = feature.properties.recovered;
-		const deaths = feature.properties.deaths;
-		const updated = confirmed[confirmed.length-1].time * 1000;
-		const lastIndex = confirmed.length - 1;
-		const lastConfirmed = confirmed[lastIndex].count;
-		const lastRecovered = recovered[lastIndex].count;
-		const lastDeaths = deaths[lastIndex].count;
-
-		if((countryToDisplay && country != countryToDisplay) ||
-		   (!lastConfirmed && !lastRecovered && !lastDeaths))
-			return;
-
-		if((country == 'United States' && admin2) ||
-		   (country != 'United States' &&
-		    (hasDuplicateData.indexOf(country) < 0 || province))){
-			// country statistics
-			statsByProvince +=
-				'<div id="feature-' + featureId +
-					'" class="stats-by-province">' +
-				'<div>' + createLinks(country, province, admin2, featureId,
-									  false) + '</div>' +
-				'<div onclick="showFeatureStatsById(' + featureId + ')">';
-			if(lastConfirmed)
-				statsByProvince += '<div class="confirmed">' +
-					getConfirmedText(lastConfirmed) + '</div>';
-			if(lastRecovered)
-				statsByProvince += '<div class="recovered">' +
-					getRecoveredText(lastRecovered) + '</div>';
-			if(lastDeaths)
-				statsByProvince += '<div class="deaths">' +
-					getDeathsText(lastDeaths) + '</div>';
-			statsByProvince += '</div></div>';
-
-			if(updated > lastUpdated)
-				lastUpdated = updated;
-
-			if(countryToDisplay){
-				const coor = ol.proj.fromLonLat(feature.geometry.coordinates);
-				ol.extent.extend(extent, [coor[0], coor[1], coor[0], coor[1]]);
-				const name = province || country;
-
-				statsByCountry[name] =
-					{time: [], confirmed: [], recovered: [], deaths: []};
-				for(let i = 0; i < confirmed.length; i++){
-					const t = confirmed[i].time;
-					const c = confirmed[i].count;
-					const r = recovered[i].count;
-					const d = deaths[i].count;
-
-					// province statistics
-					statsByCountry[name].time.push(getDate(t));
-					statsByCountry[name].confirmed.push(c);
-					statsByCountry[name].recovered.push(r);
-					statsByCountry[name].deaths.push(d);
-				}
-			}
-
-			// don't double count for global statistics
-			if(country == 'United States' ||
-			   hasDuplicateData.indexOf(country) >= 0)
-				return;
-		}else if(country == 'United States' && province)
-			return;
-
-		// global statistics
-		if(updated > lastUpdated)
-			lastUpdated = updated;
-
-		if(!countryToDisplay && !statsByCountry[country])
-			statsByCountry[country] =
-				{time: [], confirmed: [], recovered: [], deaths: []};
-
-		for(let i = 0; i < confirmed.length; i++){
-			const t = confirmed[i].time;
-			const c = confirmed[i].count;
-			const r = recovered[i].count;
-			const d = deaths[i].count;
-
-			if(!countryToDisplay){
-				// country statistics
-				if(statsByCountry[country].confirmed.length < confirmed.length){
-					statsByCountry[country].time.push(getDate(t));
-					statsByCountry[country].confirmed.push(c);
-					statsByCountry[country].recovered.push(r);
-					statsByCountry[country].deaths.push(d);
-				}else{
-					statsByCountry[country].confirmed[i] += c;
-					statsByCountry[country].recovered[i] += r;
-					statsByCountry[country].deaths[i] += d;
-				}
-			}
-
-			// global statistics
-			if(i + 1 > time.length){
-				// https://stackoverflow.com/a/50130338
-				time.push(getDate(confirmed[i].time));
-				confirmedCount.push(c);
-				recoveredCount.push(r);
-				deathsCount.push(d);
-			}else{
-				confirmedCount[i] += c;
-				recoveredCount[i] += r;
-				deathsCount[i] += d;
-			}
-			if(i == confirmed.length - 1 &&
-			   confirmedCount.length > confirmed.length){
-				const k = confirmedCount.length - 1;
-				confirmedCount[k] += c;
-				recoveredCount[k] += r;
-				deathsCount[k] += d;
-			}
-		}
-
-		if(lastConfirmed - lastRecovered - lastDeaths > maxActive){
-			maxActive = lastConfirmed - lastRecovered - lastDeaths;
-			maxConfirmedCoor = [longitude, latitude];
-		}
+	stats.provinces.forEach(feature => {
+		const featureId = feature.featureId;
+		const lastConfirmed = feature.confirmed;
+		const lastRecovered = feature.recovered;
+		const lastDeaths = feature.deaths;
+
+		statsByProvince +=
+			'<div id="feature-' + featureId +
+				'" class="stats-by-province">' +
+			'<div>' + createLinks(feature.country, feature.province,
+								  feature.admin2, featureId, false) + '</div>' +
+			'<div onclick="showFeatureStatsById(' + featureId + ')">';
+		if(lastConfirmed)
+			statsByProvince += '<div class="confirmed">' +
+				getConfirmedText(lastConfirmed) + '</div>';
+		if(lastRecovered)
+			statsByProvince += '<div class="recovered">' +
+				getRecoveredText(lastRecovered) + '</div>';
+		if(lastDeaths)
+			statsByProvince += '<div class="deaths">' +
+				getDeathsText(lastDeaths) + '</div>';
+		statsByProvince += '</div></div>';
 	});
-	Object.entries(statsByCountry).forEach(([country, stats]) => {
-		const lastIndex = stats.confirmed.length - 1;
-		const confirmed = stats.confirmed[lastIndex];
-		const recovered = stats.recovered[lastIndex];
-		const deaths = stats.deaths[lastIndex];
-		sortedByCountry.push({
-			country: country,
-			confirmed: confirmed,
-			recovered: recovered,
-			deaths: deaths,
-			active: confirmed - recovered - deaths,
-			cfrDDR: roundCFR(deaths / (deaths + recovered))
-		});
-	});
-
 	statsByProvinceEl.innerHTML = statsByProvince;
 
-	for(let i = 0; i < time.length; i++){
-		confirmedIncrease.push(confirmedCount[i] -
-			(i > 0 ? confirmedCount[i - 1] : 0));
-		recoveredIncrease.push(recoveredCount[i] -
-			(i > 0 ? recoveredCount[i - 1] : 0));
-		deathsIncrease.push(deathsCount[i] - (i > 0 ? deathsCount[i - 1] : 0));
-		cfrT.push(i >= averageDaysFromConfirmedToDeath ?
-			roundCFR(deathsCount[i] /
-				confirmedCount[i - averageDaysFromConfirmedToDeath]) : null);
-		cfrDDR.push(deathsCount[i] + recoveredCount[i] ?
-			roundCFR(deathsCount[i] /
-				(deathsCount[i] + recoveredCount[i])) : null);
-	}
+	statsByCountry = stats.statsByCountry;
+	time = stats.time;
+	confirmedCount = stats.confirmed;
+	recoveredCount = stats.recovered;
+	deathsCount = stats.deaths;
+	confirmedIncrease = stats.confirmedIncrease;
+	recoveredIncrease = stats.recoveredIncrease;
+	deathsIncrease = stats.deathsIncrease;
+	averageIncrease = stats.averageIncrease;
+	cfrT = stats.cfrT;
+	cfrDDR = stats.cfrDDR;
 
 	const lastIndex = time.length - 1;
 	lastUpdatedEl.innerHTML = new Date(lastUpdated).toLocaleString();
@@ -1116,46 +952,31 @@ function showGlobalStats(panToMaxConfirmed){
 		summaryEl.offsetHeight - plotsEl.offsetHeight - 6) + 'px';
 
 	if(panToMaxConfirmed){
-		if(extent)
+		if(countryToDisplay){
+			const extent = new ol.extent.createEmpty();
+			stats.coordinates.forEach(coordinates => {
+				const coor = ol.proj.fromLonLat(coordinates);
+				ol.extent.extend(extent, [coor[0], coor[1], coor[0], coor[1]]);
+			});
 			zoomToExtent(extent);
-		else
-			panToCoordinates(ol.proj.fromLonLat(maxConfirmedCoor));
+		}else
+			panToCoordinates(ol.proj.fromLonLat(stats.maxConfirmedCoor));
 	}
 }
 
 let sortDescending = true;
 function sortStatsByCountry(category){
-	let nextCategory;
-	sortedByCountry.sort(function(a, b){
-		switch(category){
-		case 'Confirmed':
-			nextCategory = 'Recovered';
-			a = a.confirmed;
-			b = b.confirmed;
-			break;
-		case 'Recovered':
-			nextCategory = 'Deaths';
-			a = a.recovered;
-			b = b.recovered;
-			break;
-		case 'Deaths':
-			nextCategory = 'Active';
-			a = a.deaths;
-			b = b.deaths;
-			break;
-		case 'Active':
-			nextCategory = 'CFR d/(d+r)';
-			a = a.active;
-			b = b.active;
-			break;
-		case 'CFR d/(d+r)':
-			nextCategory = 'Confirmed';
-			a = a.cfrDDR;
-			b = b.cfrDDR;
-			break;
-		}
-		return sortDescending ? b - a : a - b;
+	requestWorker({
+		type: 'sort',
+		category: category,
+		sortDescending: sortDescending
+	}, result => {
+		showSortedStatsByCountry(category, result.nextCategory,
+			result.sortedByCountry);
 	});
+}
+
+function showSortedStatsByCountry(category, nextCategory, sortedByCountry){
 	countryLinksEl.innerHTML =
 		'<a onclick="sortDescending=!sortDescending;sortStatsByCountry(\'' +
 			category +
@@ -1227,6 +1048,10 @@ mapEl.style.width = (bodyWidth - infoEl.offsetWidth -
  ******************************************************************************/
 
 const popup = new ol.Overlay.Popup();
+// features are added after loading data; see showData()
+const casesSource = new ol.source.Vector({
+	attributions: '&copy; ' + getWord('Data sources') + ': ' + dataSources
+});
 const map = new ol.Map({
 	target: 'map',
 	controls: ol.control.defaults().extend([
@@ -1272,17 +1097,16 @@ const map = new ol.Map({
 				})
 			]
 		}),
-		new ol.layer.Vector({
+		new ol.layer.Group({
 			title: getWord('COVID-19 cases'),
-			source: new ol.source.Vector({
-				format: new ol.format.GeoJSON(),
-				url: dataUrl,
-				attributions: '&copy; ' + getWord('Data sources') + ': ' +
-					dataSources
-			}),
-			style: function(feature, resolution){
-				return createStyle(feature, resolution);
-			}
+			layers: [
+				new ol.layer.Vector({
+					source: casesSource,
+					style: function(feature, resolution){
+						return createStyle(feature, resolution);
+					}
+				})
+			]
 		})
 	],
 	view: new ol.View({
@@ -1319,26 +1143,89 @@ const maxResolution = view.getResolution();
  * POPULATE GLOBAL TOTAL
  ******************************************************************************/
 
+// features with their last counts for the map; their series are kept in
+// covid-19-worker.js, which loads the data and calculates statistics
 let features;
-const sortedByCountry = [];
-const xhr = new XMLHttpRequest();
-xhr.open('GET', dataUrl, true);
-xhr.responseType = 'json';
-xhr.onload = function(){
-	const status = xhr.status;
-	if(status == 200){
-		features = xhr.response.features;
-		const queryMatches = window.location.search.match(/^\?(.+)$/);
-
-		showGlobalStats(!queryMatches);
-		sortStatsByCountry('Confirmed');
-
-		if(queryMatches){
-			const query = queryMatches[1].replace(/\+|%20/g, ' ').
-				replace(/%22/g, '"');
-			showFeatureStatsByQuery(query);
+// rolling_average_days of derived metrics written with derived_metrics = True
+// in config.py
+let rollingAverageDays = null;
+const worker = new Worker('covid-19-worker.js');
+const workerCallbacks = {};
+let workerRequestId = 0;
+
+function requestWorker(message, callback){
+	message.id = ++workerRequestId;
+	workerCallbacks[message.id] = callback;
+	worker.postMessage(message);
+}
+
+// displayed features for WebGL layers if webGLPointsMinFeatures is reached
+const pointsSource = new ol.source.Vector({
+	attributions: casesSource.getAttributions()
+});
+let webGLPointsLayers = null;
+
+function showData(data){
+	features = data.features;
+	const olFeatures = new ol.format.GeoJSON().readFeatures(data, {
+		featureProjection: view.getProjection()
+	});
+	// features not displayed are not added instead of being styled with null
+	const displayedFeatures = olFeatures.filter(feature =>
+		isFeatureDisplayed(feature.get('country'), feature.get('province'),
+			feature.get('admin2')));
+	casesSource.clear();
+	pointsSource.clear();
+	// ol.layer.WebGLPoints is available in OpenLayers 6.3 or later
+	if(webGLPointsMinFeatures && ol.layer.WebGLPoints &&
+	   displayedFeatures.length >= webGLPointsMinFeatures){
+		if(!webGLPointsLayers){
+			webGLPointsLayers = createWebGLPointsLayers(pointsSource);
+			const casesLayers = map.getLayers().item(1).getLayers();
+			webGLPointsLayers.forEach(layer => casesLayers.push(layer));
 		}
+		pointsSource.addFeatures(displayedFeatures);
 	}else
-		console.log(status);
+		casesSource.addFeatures(displayedFeatures);
+}
+
+function populateStats(stats){
+	const queryMatches = window.location.search.match(/^\?(.+)$/);
+
+	showGlobalStats(stats, !queryMatches);
+	sortStatsByCountry('Confirmed');
+
+	if(queryMatches){
+		const query = queryMatches[1].replace(/\+|%20/g, ' ').
+			replace(/%22/g, '"');
+		showFeatureStatsByQuery(query);
+	}
+}
+
+worker.onmessage = function(e){
+	const message = e.data;
+	switch(message.type){
+	case 'data':
+		showData(message.data);
+		rollingAverageDays = message.rollingAverageDays;
+		populateStats(message.stats);
+		break;
+	case 'error':
+		console.log(message.status);
+		break;
+	default:
+		workerCallbacks[message.id](message.result);
+		delete workerCallbacks[message.id];
+	}
 };
-xhr.send();
+
+worker.postMessage({
+	type: 'load',
+	dataUrl: dataUrl,
+	useBinaryData: useBinaryData,
+	useDerivedMetrics: useDerivedMetrics,
+	useSearchIndex: useSearchIndex,
+	countryToDisplay: countryToDisplay,
+	hasDuplicateData: hasDuplicateData,
+	averageDaysFromConfirmedToDeath: averageDaysFromConfirmedToDeath
+});
@@ -33,11 +33,30 @@ import os
 import glob
 import copy
 import unicodedata
+import concurrent.futures
+import contextlib
+import functools
+import itertools
 import traceback
+import html.parser
 import sys
+import time
+import gzip
+import hashlib
+import array
+import bisect
+import struct
+import math
+import random
+import zipfile
 import dic
 import config
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 ts_confirmed_url = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv'
 daily_url_format = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_daily_reports/{date}.csv'
 
@@ -46,18 +65,36 @@ features_url = 'https://services9.arcgis.com/N9p5hsImWXAccRNI/arcgis/rest/servic
 kcdc_country_url = 'http://ncov.mohw.go.kr/bdBoardList_Real.do'
 kcdc_country_re = '누적 확진자 현황.*?\(([0-9]+)\.([0-9]+).*?([0-9]+)시.*?기준\).*?<td>([0-9,]+)</td>\s*<td>([0-9,]+)</td>\s*<td>[0-9,]+</td>\s*<td>([0-9,]+)</td>'
 kcdc_provinces_url = 'http://ncov.mohw.go.kr/bdBoardList_Real.do?brdGubun=13'
-kcdc_provinces_re = '([0-9]+)\.([0-9]+)\.\s*([0-9]+)시.*?기준.*?<tr class="sumline">.*?</tr>.*?(<tr>.+?)</tbody>'
-kcdc_provinces_subre = '>([^>]+)</th>.*?<[^>]+?s_type1[^>]+>\s*([0-9,]+)\s*<.+?s_type4[^>]+>\s*([0-9,]+)\s*<.+?s_type2[^>]+>\s*([0-9,]+)\s*<'
+# table columns by header text; see find_table()
+kcdc_provinces_time_re = '([0-9]+)\.([0-9]+)\.\s*([0-9]+)시.*?기준'
+kcdc_provinces_columns = {
+    'province': '시도명',
+    'confirmed': '확진환자',
+    'recovered': '격리해제',
+    'deaths': '사망자'
+}
+kcdc_provinces_total = '합계'
 
 dxy_url = 'https://ncov.dxy.cn/ncovh5/view/pneumonia'
-dxy_re = 'window\.getListByCountryTypeService2true.*?"createTime":([0-9]+),.*window\.getAreaStat = (.*?)\}catch\(e\)'
+dxy_time_var = 'window.getListByCountryTypeService2true'
+dxy_areas_var = 'window.getAreaStat'
 
 statistichecoronavirus_url = 'https://statistichecoronavirus.it/coronavirus-italia/'
-statistichecoronavirus_re = '<tr[^>]*>\s*<td[^>]*>(?:<[^>]*>){2}([^<>]*?)<[^>]*></td>\s*<td[^>]*>[^<>]*?</td>\s*<td[^>]*>([^<>]*?)</td>\s*<td[^>]*>[^<>]*?</td>\s*<td[^>]*>[^<>]*?</td>\s*<td[^>]*>([^<>]*?)</td>\s*<td[^>]*>([^<>]*?)</td>\s*</tr>'
+statistichecoronavirus_columns = {
+    'province': 'Regione',
+    'confirmed': 'Casi totali',
+    'recovered': 'Guariti',
+    'deaths': 'Deceduti'
+}
 
 minsal_url = 'https://www.minsal.cl/nuevo-coronavirus-2019-ncov/casos-confirmados-en-chile-covid-19/'
-minsal_re = '<tr[^>]*>.*?<td[^>]*>([^<>]+)</td>.*?<td[^>]*>([0-9.]+)</td>.*?(?:<td[^>]*>[0-9.]+</td>.*?){3}<td[^>]*>([0-9.]+)</td>.*?<td[^>]*>[0-9,.]+ *%</td>.*?</tr>'
-minsal_total_re = '<tr[^>]*>.*?<td[^>]*><strong>Total</strong></td>.*?<td[^>]*><strong>([0-9.]+)</strong></td>.*?(?:<td[^>]*><strong>[0-9.]+</strong></td>.*?){3}<td[^>]*><strong>([0-9.]+)</strong></td>.*?<td[^>]*><strong>[0-9,.]+ *%</strong></td>.*?</tr>.*?<tr[^>]*>.*?<td[^>]*><strong>Casos recuperados a nivel nacional\s*</strong></td>.*?<td[^>]*><strong>([0-9.]+)</strong></td>.*?</tr>'
+minsal_columns = {
+    'province': 'Región',
+    'confirmed': 'Casos totales acumulados',
+    'deaths': 'Fallecidos'
+}
+minsal_total = 'Total'
+minsal_recovered = 'Casos recuperados a nivel nacional'
 
 geocode_country_url = f'http://dev.virtualearth.net/REST/v1/Locations?countryRegion={{country}}&key={config.bing_maps_key}'
 geocode_province_url = f'http://dev.virtualearth.net/REST/v1/Locations?countryRegion={{country}}&adminDistrict={{province}}&key={config.bing_maps_key}'
@@ -65,28 +102,421 @@ geocode_admin2_url = f'http://dev.virtualearth.net/REST/v1/Locations?countryRegi
 
 geodata_json = 'geodata.json'
 data_csv = 'data.csv'
+data_npz = 'data.npz'
+data_long_npz = 'data-long.npz'
+hashes_json = 'hashes.json'
+deltas_dir = 'deltas'
+manifest_json = 'manifest.json'
+anomalies_json = 'anomalies.json'
+
+# files changed or removed in this run; see write_manifest()
+changed_files = {}
+removed_files = []
 
 # use this dictionary to avoid geocoding the same province multiple times
 coors_json = 'coors.json'
-
-dates = []
-data = []
-key2data = {}
-has_countries_to_display = True if len(config.countries_to_display) else False
-has_duplicate_data = []
-total_days = 0
+coors = None
+
+# coordinates found in daily reports and REST features; these, coors, and
+# dic.latlong are indexed by location and normalized location to avoid geocoding
+gazetteer_json = 'gazetteer.json'
+gazetteer = None
+location_index = {}
+normalized_location_index = {}
+location_suffixes = (' city and borough', ' census area', ' municipality',
+                     ' prefecture', ' province', ' district', ' borough',
+                     ' county', ' parish', ' region', ' oblast')
+
+# reuse connections to the same servers
+session = requests.Session()
+
+# request latencies in seconds by data source; see report_latencies()
+latencies = {}
+# page parse times in seconds by data source
+parse_times = {}
+
+def init_worker():
+    # don't share the parent's pooled connections with worker processes
+    global session
+    session = requests.Session()
+
+def close_response(future):
+    if not future.exception():
+        future.result().close()
+
+def hedged_get(source, url, **kwargs):
+    # send a duplicate request if the first one does not respond in time and
+    # use whichever responds first
+    delay = config.hedge_delays.get(source)
+    if delay is None:
+        return session.get(url, **kwargs)
+
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    try:
+        futures = [executor.submit(session.get, url, **kwargs)]
+        done, pending = concurrent.futures.wait(futures, timeout=delay)
+        if not done:
+            futures.append(executor.submit(session.get, url, **kwargs))
+        while True:
+            done, pending = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if not future.exception():
+                    # close the slower response when it arrives
+                    for other in pending:
+                        other.add_done_callback(close_response)
+                    return future.result()
+            if not pending:
+                raise done.pop().exception()
+            futures = list(pending)
+    finally:
+        executor.shutdown(wait=False)
+
+def http_get(source, url, **kwargs):
+    # all requests go through here with per-source timeouts and bounded retries
+    # with jittered exponential backoff on network errors and server errors
+    timeout = config.http_timeouts.get(source, config.http_timeouts['default'])
+    for attempt in range(config.http_retries + 1):
+        last_attempt = attempt == config.http_retries
+        start = time.time()
+        try:
+            res = hedged_get(source, url, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            if last_attempt:
+                raise
+            print(f'Request to {source} failed; retrying...')
+        else:
+            latencies.setdefault(source, []).append(time.time() - start)
+            if (res.status_code < 500 and res.status_code != 429) or \
+               last_attempt:
+                return res
+            res.close()
+            print(f'Request to {source} returned {res.status_code}; '
+                  'retrying...')
+        time.sleep(random.uniform(0, config.http_backoff * 2**attempt))
+
+def call_with_latencies(func, *args, **kwargs):
+    # return the result of func with the latencies of its requests so that
+    # latencies measured in worker processes can be reported
+    n = {source: len(x) for source, x in latencies.items()}
+    result = func(*args, **kwargs)
+    new_latencies = {}
+    for source, x in latencies.items():
+        new_latencies[source] = x[n.get(source, 0):]
+        del x[n.get(source, 0):]
+    return result, new_latencies
+
+def add_latencies(new_latencies):
+    for source, x in new_latencies.items():
+        latencies.setdefault(source, []).extend(x)
+
+def report_latencies():
+    for source, x in sorted(latencies.items()):
+        if not x:
+            continue
+        x = sorted(x)
+        p50, p90, p99 = (x[min(int(len(x) * p), len(x) - 1)]
+                         for p in (0.5, 0.9, 0.99))
+        print(f'{source}: {len(x)} requests, p50 {p50:.2f}s, '
+              f'p90 {p90:.2f}s, p99 {p99:.2f}s, max {x[-1]:.2f}s')
+    for source, x in sorted(parse_times.items()):
+        print(f'{source}: {len(x)} pages parsed, '
+              f'average {sum(x) / len(x):.3f}s, max {max(x):.3f}s')
+
+class TableParser(html.parser.HTMLParser):
+    # collect the rows of all tables as lists of cell texts in one pass; cells
+    # spanning multiple rows or columns are repeated so that columns line up
+    # with headers; text outside tables and scripts are also kept
+    def __init__(self):
+        super().__init__()
+        self.tables = []
+        self.texts = []
+        self.scripts = []
+        self.open_tables = []
+        self.script = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'script':
+            self.script = []
+        elif tag == 'table':
+            table = {'rows': [], 'header_rows': 0, 'row': None,
+                     'data_row': False, 'cell': None, 'spans': {}}
+            self.tables.append(table)
+            self.open_tables.append(table)
+        elif self.open_tables:
+            table = self.open_tables[-1]
+            if tag == 'tr':
+                self.end_row(table)
+                table['row'] = []
+            elif tag in ('th', 'td'):
+                self.end_cell(table)
+                if table['row'] is None:
+                    table['row'] = []
+                attrs = dict(attrs)
+                table['cell'] = {
+                    'header': tag == 'th',
+                    'text': [],
+                    'colspan': self.get_span(attrs, 'colspan'),
+                    'rowspan': self.get_span(attrs, 'rowspan')
+                }
+
+    def handle_endtag(self, tag):
+        if tag == 'script':
+            if self.script is not None:
+                self.scripts.append(''.join(self.script))
+            self.script = None
+        elif self.open_tables:
+            table = self.open_tables[-1]
+            if tag == 'table':
+                self.end_row(table)
+                self.open_tables.pop()
+            elif tag == 'tr':
+                self.end_row(table)
+            elif tag in ('th', 'td'):
+                self.end_cell(table)
+
+    def handle_data(self, data):
+        if self.script is not None:
+            self.script.append(data)
+        elif self.open_tables:
+            cell = self.open_tables[-1]['cell']
+            if cell:
+                cell['text'].append(data)
+        elif data.strip():
+            self.texts.append(' '.join(data.split()))
+
+    def get_span(self, attrs, name):
+        try:
+            return max(int(attrs.get(name) or 1), 1)
+        except ValueError:
+            return 1
+
+    def fill_spans(self, table):
+        row = table['row']
+        spans = table['spans']
+        while len(row) in spans:
+            span = spans[len(row)]
+            row.append(span[1])
+            span[0] -= 1
+            if not span[0]:
+                del spans[len(row) - 1]
+
+    def end_cell(self, table):
+        cell = table['cell']
+        if not cell:
+            return
+        row = table['row']
+        self.fill_spans(table)
+        text = ' '.join(''.join(cell['text']).split())
+        for i in range(cell['colspan']):
+            if cell['rowspan'] > 1:
+                table['spans'][len(row)] = [cell['rowspan'] - 1, text]
+            row.append(text)
+        if not cell['header']:
+            table['data_row'] = True
+        table['cell'] = None
+
+    def end_row(self, table):
+        self.end_cell(table)
+        row = table['row']
+        if row is None:
+            return
+        self.fill_spans(table)
+        if row:
+            # leading rows with header cells only
+            if not table['data_row'] and \
+               len(table['rows']) == table['header_rows']:
+                table['header_rows'] += 1
+            table['rows'].append(row)
+        table['row'] = None
+        table['data_row'] = False
+
+def parse_html(source, content):
+    start = time.time()
+    parser = TableParser()
+    parser.feed(content)
+    parser.close()
+    parse_time = time.time() - start
+    parse_times.setdefault(source, []).append(parse_time)
+    print(f'Parsed {source} page in {parse_time:.3f}s')
+    return parser
+
+def normalize_header(text):
+    return strip_accents(' '.join(text.split())).lower()
+
+def find_table(tables, columns, source=None):
+    # find the first table with all the columns by header text and return the
+    # indices of the columns and the rows below the header; header cells
+    # matching the text exactly take precedence over those starting with it,
+    # which take precedence over those containing it
+    missing = list(columns.values())
+    for table in tables:
+        rows = table['rows']
+        header_rows = table['header_rows'] or 1
+        headers = {}
+        for row in rows[:header_rows]:
+            for i, text in enumerate(row):
+                headers.setdefault(i, set()).add(normalize_header(text))
+        indices = {}
+        for name, header in columns.items():
+            header = normalize_header(header)
+            for match in (str.__eq__, str.startswith, str.__contains__):
+                index = next((i for i, texts in sorted(headers.items())
+                              if any(match(text, header) for text in texts)),
+                             None)
+                if index is not None:
+                    indices[name] = index
+                    break
+        if len(indices) == len(columns):
+            return indices, rows[header_rows:]
+        # headers missing from the closest table
+        if len(columns) - len(indices) < len(missing):
+            missing = [header for name, header in columns.items()
+                       if name not in indices]
+    if source:
+        print(f'Warning: no {source} table with headers: {", ".join(missing)}')
+    return None, None
+
+def find_script_value(scripts, name):
+    # decode the JSON value assigned to name in scripts
+    decoder = json.JSONDecoder()
+    for script in scripts:
+        m = re.search(re.escape(name) + r'\s*=\s*', script)
+        if m:
+            return decoder.raw_decode(script, m.end())[0]
+
+def replace_file(filename, content):
+    # readers never see a partially written file
+    tmp_filename = f'{filename}.tmp{os.getpid()}'
+    with open(tmp_filename, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+def has_content(filename, content):
+    if os.path.exists(filename) and \
+       os.path.getsize(filename) == len(content):
+        with open(filename, 'rb') as f:
+            return f.read() == content
+    return False
+
+def write_file(filename, content):
+    # write only changed files so that deployment can upload only those files
+    if isinstance(content, str):
+        content = content.encode()
+    if has_content(filename, content):
+        return False
+    replace_file(filename, content)
+    changed_files[filename] = {
+        'size': len(content),
+        'sha256': hashlib.sha256(content).hexdigest()
+    }
+    return True
+
+def remove_file(filename):
+    os.remove(filename)
+    changed_files.pop(filename, None)
+    removed_files.append(filename)
+
+def write_manifest():
+    # list files changed since the last deployment; entries accumulate across
+    # runs until deployment consumes the manifest by deleting it
+    changed = {}
+    removed = []
+    if os.path.exists(manifest_json):
+        with open(manifest_json) as f:
+            manifest = json.load(f)
+        changed = manifest['changed']
+        removed = manifest['removed']
+    elif not changed_files and not removed_files:
+        return
+    changed.update(changed_files)
+    for filename in removed_files:
+        changed.pop(filename, None)
+    removed = [filename for filename in removed if filename not in changed]
+    removed.extend(filename for filename in removed_files
+                   if filename not in removed)
+    manifest = {
+        'changed': changed,
+        'removed': removed
+    }
+    replace_file(manifest_json, json.dumps(manifest, indent=1).encode())
+
+def is_country_to_display(country, countries_to_display):
+    return not countries_to_display or country in countries_to_display
+
+def normalize_location_name(name):
+    # St. Louis County and Saint Louis are both st louis, but St. Louis City is
+    # st louis city because independent cities are not their counties
+    name = re.sub('[^a-z0-9]+', ' ', strip_accents(name).lower()).strip()
+    name = re.sub('^county of ', '', name)
+    name = re.sub('^city of (.+)', r'\1 city', name)
+    name = re.sub('^saint ', 'st ', name)
+    for suffix in location_suffixes:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def index_location(location, latlong):
+    if latlong['latitude'] is None or latlong['longitude'] is None:
+        return
+    location_index.setdefault(location, latlong)
+    normalized = tuple(normalize_location_name(x) for x in read_key(location))
+    other = normalized_location_index.setdefault(normalized, location)
+    if other != location:
+        # don't guess between different locations with the same name
+        normalized_location_index[normalized] = None
+
+def load_gazetteer():
+    # read existing data only once
+    global coors, gazetteer
+
+    if gazetteer is not None:
+        return
+    if os.path.exists(coors_json):
+        with open(coors_json) as f:
+            coors = json.load(f)
+    else:
+        coors = {}
+    if os.path.exists(gazetteer_json):
+        with open(gazetteer_json) as f:
+            gazetteer = json.load(f)
+    else:
+        gazetteer = {}
+    for locations in (dic.latlong, coors, gazetteer):
+        for location, latlong in locations.items():
+            index_location(location, latlong)
+
+def add_to_gazetteer(country, province, admin2, latitude, longitude):
+    # remember coordinates in the data for locations without them later
+    location = generate_key(country, province, admin2)
+    if location in location_index:
+        return
+    load_gazetteer()
+    if latitude and longitude:
+        gazetteer[location] = {'latitude': latitude, 'longitude': longitude}
+        index_location(location, gazetteer[location])
+
+def lookup_gazetteer(country, province, admin2):
+    load_gazetteer()
+    location = generate_key(country, province, admin2)
+    if location not in location_index:
+        location = normalized_location_index.get(tuple(
+            normalize_location_name(x) for x in (country, province, admin2)))
+        if location is None:
+            return None
+    latlong = location_index[location]
+    return latlong['latitude'], latlong['longitude']
+
+def write_gazetteer():
+    if gazetteer is not None:
+        write_file(gazetteer_json, json.dumps(gazetteer))
 
 def geocode(country, province='', admin2='', latitude=None, longitude=None):
     # https://docs.microsoft.com/en-us/bingmaps/rest-services/common-parameters-and-types/location-and-area-types
     # XXX: adminDistrict2 doesn't work?
     # adminDistrict=County,State works!
 
-    # read existing data
-    if os.path.exists(coors_json):
-        with open(coors_json) as f:
-            coors = json.load(f)
-    else:
-        coors = {}
+    load_gazetteer()
 
     if admin2:
         location = f'{admin2}, {province}, {country}'
@@ -101,12 +531,17 @@ def geocode(country, province='', admin2='', latitude=None, longitude=None):
         geocode_url = geocode_country_url.format(country=country)
 
     if location not in coors:
+        # try local data before geocoding
+        latlong = lookup_gazetteer(country, province, admin2)
+        if latlong:
+            return latlong
+
         if config.bing_maps_key == 'BING_MAPS_KEY':
             raise Exception('Please set up bing_maps_key in config.py')
         if config.bing_maps_referer == 'BING_MAPS_REFERER':
             raise Exception('Please set up bing_maps_referer in config.py')
 
-        res = requests.get(geocode_url, headers={
+        res = http_get('bing', geocode_url, headers={
             'referer': config.bing_maps_referer
         })
         ret = res.json()
@@ -118,71 +553,29 @@ def geocode(country, province='', admin2='', latitude=None, longitude=None):
         coors[location] = {'latitude': latitude, 'longitude': longitude}
 
         if latitude is not None and longitude is not None:
-            with open(coors_json, 'w') as f:
-                f.write(json.dumps(coors))
+            write_file(coors_json, json.dumps(coors))
+            index_location(location, coors[location])
     else:
         latitude = coors[location]['latitude']
         longitude = coors[location]['longitude']
 
     return latitude, longitude
 
-def fetch_csse_csv():
-    global total_days
-
-    print('Fetching CSSE CSV...')
-
-    ts_confirmed_res = requests.get(ts_confirmed_url)
-    with io.StringIO(ts_confirmed_res.content.decode()) as ts_confirmed_f:
-        ts_confirmed_reader = csv.reader(ts_confirmed_f)
-        header = ts_confirmed_reader.__next__()
-        # reverse order to find more recent and fully populated data first
-        j = 0
-        for i in range(len(header) - 1, 3, -1):
-            date = header[i].split('/')
-            year = 2000 + int(date[2])
-            month = int(date[0])
-            day = int(date[1])
-
-            date = f'{year}-{month:02}-{day:02}'
-            dates.insert(0, date)
-
-            print(f'{date}...', end='', flush=True)
-            j += 1
-            if j % 5 == 0:
-                print('')
-
-            fetch_csse_daily_csv(year, month, day)
-            total_days += 1
-        if j % 5:
-            print('')
-
-    for rec in data:
-        for category in ('confirmed', 'recovered', 'deaths'):
-            i = 0
-            insert = {}
-            for x in rec[category]:
-                date = x['time'].strftime('%Y-%m-%d')
-                while i < total_days - 1 and dates[i] < date:
-                    insert[i] = {
-                        'time': datetime.datetime.fromisoformat(
-                            f'{dates[i]} 23:59:59+00:00'),
-                        'count': 0,
-                    }
-                    i += 1
-                i += 1
-            for key in sorted(insert.keys()):
-                rec[category].insert(key, insert[key])
-            index = len(rec[category]) - 1
-            while i < total_days:
-                # TODO: aggregate
-                rec[category].append({
-                    'time': datetime.datetime.fromisoformat(
-                        f'{dates[i]} 23:59:59+00:00'),
-                    'count': rec[category][index]['count']
-                })
-                i += 1
-
-    print('Fetching CSSE CSV completed')
+@contextlib.contextmanager
+def open_csv(url, source='csse'):
+    # read a CSV file line by line as it arrives instead of decoding the entire
+    # response first; local files go through the same path
+    if url.startswith(('http://', 'https://')):
+        with http_get(source, url, stream=True) as res:
+            res.raw.decode_content = True
+            # urllib3 closes the stream once it is read to the end, which
+            # TextIOWrapper doesn't expect
+            res.raw.auto_close = False
+            with io.TextIOWrapper(res.raw, encoding='utf-8', newline='') as f:
+                yield csv.reader(f)
+    else:
+        with open(url, newline='') as f:
+            yield csv.reader(f)
 
 def generate_key(country, province, admin2):
     if admin2:
@@ -200,14 +593,31 @@ def read_key(key):
     admin2 = x.pop() if len(x) else ''
     return country, province, admin2
 
-def fetch_csse_daily_csv(year, month, day):
+def fetch_csse_daily_dates():
+    # only the header is needed; stop reading once we have it
+    with open_csv(ts_confirmed_url) as ts_confirmed_reader:
+        header = ts_confirmed_reader.__next__()
+
+    # reverse order to find more recent and fully populated data first
+    daily_dates = []
+    for i in range(len(header) - 1, 3, -1):
+        date = header[i].split('/')
+        year = 2000 + int(date[2])
+        month = int(date[0])
+        day = int(date[1])
+        daily_dates.append((year, month, day))
+    return daily_dates
+
+def parse_csse_daily_csv(date, countries_to_display=()):
+    # this function runs in worker processes; it only reads the daily report and
+    # returns a compact partial result without touching the pipeline
+    year, month, day = date
     date_iso = f'{year}-{month:02}-{day:02}'
     date_csv = f'{month:02}-{day:02}-{year}'
 
+    records = {}
     url = daily_url_format.format(date=date_csv)
-    res = requests.get(url)
-    with io.StringIO(res.content.decode()) as f:
-        reader = csv.reader(f)
+    with open_csv(url) as reader:
         header = reader.__next__()
         ncols = len(header)
         for row in reader:
@@ -298,77 +708,57 @@ def fetch_csse_daily_csv(year, month, day):
             if ',' in country:
                 raise Exception('Commas are not allowed in country names: '
                         f'{country} in {date_csv}')
-            last_updated = datetime.datetime.fromisoformat(
-                    f'{date_iso} 23:59:59+00:00')
             key = generate_key(country, province, admin2)
             if key in dic.keymap:
                 key = dic.keymap[key]
                 country, province, admin2 = read_key(key)
-            if key in dic.latlong:
-                latlong = dic.latlong[key]
-                latitude = latlong['latitude']
-                longitude = latlong['longitude']
-            if not latitude or not longitude:
-                latitude, longitude = geocode(country, province, admin2)
-                if not latitude or not longitude:
-                    raise Exception('Latitude or longitude is not defined for '
-                            f'{key} in {date_csv}')
-            if key not in key2data:
-                if total_days > 0 and \
-                   (country != 'United States' or
-                    province not in dic.us_states.values() or
-                    admin2 == 'Unassigned'):
-                    continue
-                # new record not in data
-                index = len(data)
-                key2data[key] = index
-                # create and populate three lists with time series data
-                confirmed = []
-                recovered = []
-                deaths = []
-                data.append({
-                    'country': country,
-                    'province': province,
-                    'admin2': admin2,
-                    'latitude': latitude,
-                    'longitude': longitude,
-                    'confirmed': confirmed,
-                    'recovered': recovered,
-                    'deaths': deaths
-                })
+            # drop excluded countries before they reach geocoding and the data
+            if not is_country_to_display(country, countries_to_display):
+                continue
+            if key in records:
+                # duplicate entries with different counts; take the max
+                rec = records[key]
+                records[key] = (*rec[:5], max(rec[5], c), max(rec[6], r),
+                                max(rec[7], d))
             else:
-                # retrieve existing lists
-                index = key2data[key]
-                rec = data[index]
-                confirmed = rec['confirmed']
-                recovered = rec['recovered']
-                deaths = rec['deaths']
-                found = False
-                for i in range(0, len(confirmed)):
-                    if rec['confirmed'][i]['time'] == last_updated:
-                        if c > rec['confirmed'][i]['count']:
-                            rec['confirmed'][i]['count'] = c
-                        if c > rec['recovered'][i]['count']:
-                            rec['recovered'][i]['count'] = c
-                        if c > rec['deaths'][i]['count']:
-                            rec['deaths'][i]['count'] = c
-                        found = True
-                        break
-                if found:
-                    continue
-
-            confirmed.insert(0, {
-                'time': last_updated,
-                'count': c
-            })
-            recovered.insert(0, {
-                'time': last_updated,
-                'count': r
-            })
-            deaths.insert(0, {
-                'time': last_updated,
-                'count': d
-            })
+                records[key] = (country, province, admin2, latitude, longitude,
+                                c, r, d)
+
+    return date_iso, records
+
+def get_checkpoint_filename(date):
+    year, month, day = date
+    return f'{config.checkpoint_dir}/{year}-{month:02}-{day:02}.json'
+
+def write_checkpoint(date, parsed, countries_to_display=()):
+    # save a parsed daily report so that a failed run can be resumed without
+    # parsing it again
+    date_iso, records = parsed
+    checkpoint = {
+        'countries_to_display': sorted(countries_to_display),
+        'date': date_iso,
+        'records': records
+    }
+    filename = get_checkpoint_filename(date)
+    content = json.dumps(checkpoint, separators=(',', ':')).encode()
+    # runs without --resume parse every report again, but most checkpoints
+    # don't change
+    if has_content(filename, content):
+        return
+    os.makedirs(config.checkpoint_dir, exist_ok=True)
+    replace_file(filename, content)
+
+def read_checkpoint(date, countries_to_display=()):
+    # return None if the daily report was not parsed for the same countries
+    filename = get_checkpoint_filename(date)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        checkpoint = json.load(f)
+    if checkpoint['countries_to_display'] != sorted(countries_to_display):
+        return None
+    return checkpoint['date'], {key: tuple(value) for key, value in
+                                checkpoint['records'].items()}
 
 def fetch_all_features(features_url):
     count = 1000
@@ -380,7 +770,7 @@ def fetch_all_features(features_url):
         if config.app_url == 'APP_URL':
             raise Exception('Please set up app_url in config.py')
 
-        res = requests.get(url, headers={
+        res = http_get('csse_rest', url, headers={
             'referer': config.app_url
         })
         res = json.loads(res.content.decode())
@@ -391,302 +781,119 @@ def fetch_all_features(features_url):
         offset += count
     return features
 
-def fetch_csse_rest():
-    global total_days
-
-    print('Fetching CSSE REST...')
-
-    features = fetch_all_features(features_url)
-    with open('data/csse_rest.json', 'w') as f:
-        f.write(json.dumps(features))
-
-    today_iso = datetime.datetime.utcnow().strftime('%Y-%m-%d 00:00:00+00:00')
-    today = datetime.datetime.fromisoformat(today_iso)
-
-    # try to find most up-to-date info from the REST server
-    for feature in features:
-        attr = feature['attributes']
-        c = int(attr['Confirmed'])
-        r = int(attr['Recovered'])
-        d = int(attr['Deaths'])
+def get_rest_feature_key(feature):
+    attr = feature['attributes']
+    return attr['Country_Region'], attr['Province_State'], attr['Admin2']
 
-        if c + r + d == 0:
-            continue
-
-        country = attr['Country_Region'].strip()
-        if country in dic.co_names:
-            country = dic.co_names[country]
-        province = attr['Province_State'].strip() \
-            if attr['Province_State'] else ''
-        admin2 = attr['Admin2'].strip() if attr['Admin2'] else ''
-        last_updated = datetime.datetime.fromtimestamp(
-                attr['Last_Update']/1000, tz=datetime.timezone.utc)
-        # sometimes, the last date in the CSV file is later than REST; in this
-        # case, let's use today's time at 00:00:00
-        if today > last_updated:
-            last_updated = today
-        if 'geometry' in feature:
-            latitude = feature['geometry']['y']
-            longitude = feature['geometry']['x']
-
-        key = generate_key(country, province, admin2)
-        if key in dic.keymap:
-            key = dic.keymap[key]
-            country, province, admin2 = read_key(key)
-        if key in dic.latlong:
-            latlong = dic.latlong[key]
-            latitude = latlong['latitude']
-            longitude = latlong['longitude']
-        if not latitude or not longitude:
-            latitude, longitude = geocode(country, province, admin2)
-            if not latitude or not longitude:
-                raise Exception('Latitude or longitude is not defined for '
-                        f'{key} in {date_csv}')
-        if key not in key2data:
-            # new record not in data
-            index = len(data)
-            key2data[key] = index
-            # create and populate three lists with REST data
-            confirmed = copy.deepcopy(data[0]['confirmed'])
-            recovered = copy.deepcopy(data[0]['recovered'])
-            deaths = copy.deepcopy(data[0]['deaths'])
-            if len(confirmed) > total_days:
-                index = len(confirmed) - 1
-                del confirmed[index], recovered[index], deaths[index]
-            for i in range(0, total_days):
-                confirmed[i]['count'] = recovered[i]['count'] = \
-                deaths[i]['count'] = 0
-            data.append({
-                'country': country,
-                'province': province,
-                'admin2': admin2,
-                'latitude': latitude,
-                'longitude': longitude,
-                'confirmed': confirmed,
-                'recovered': recovered,
-                'deaths': deaths
-            })
-
-            if c:
-                print(f'REST confirmed: {admin2}, {province}, {country}, '
-                        f'0 => {c}')
-            if r:
-                print(f'REST recovered: {admin2}, {province}, {country}, '
-                        f'0 => {r}')
-            if d:
-                print(f'REST deaths   : {admin2}, {province}, {country}, '
-                        f'0 => {d}')
-        else:
-            # retrieve existing lists
-            index = key2data[key]
-            rec = data[index]
-            country = rec['country']
-            province = rec['province']
-            admin2 = rec['admin2']
-            confirmed = rec['confirmed']
-            recovered = rec['recovered']
-            deaths = rec['deaths']
-            time = confirmed[len(confirmed) - 1]['time']
-            # I found this case where a time from the spreadsheet is more
-            # recent than the last updated time from the REST server
-            if time > last_updated:
-                last_updated = time
-
-            index = len(confirmed) - 1
-            c = max(confirmed[index]['count'], c)
-            r = max(recovered[index]['count'], r)
-            d = max(deaths[index]['count'], d)
-            if c != confirmed[index]['count']:
-                print(f'REST confirmed: {admin2}, {province}, {country}, '
-                        f'{confirmed[index]["count"]} => {c}')
-            if r != recovered[index]['count']:
-                print(f'REST recovered: {admin2}, {province}, {country}, '
-                        f'{recovered[index]["count"]} => {r}')
-            if d != deaths[index]['count']:
-                print(f'REST deaths   : {admin2}, {province}, {country}, '
-                        f'{deaths[index]["count"]} => {d}')
-
-        if len(confirmed) == total_days + 1:
-            continue
-
-        confirmed.append({
-            'time': last_updated,
-            'count': c
-        }),
-        recovered.append({
-            'time': last_updated,
-            'count': r
-        }),
-        deaths.append({
-            'time': last_updated,
-            'count': d
-        })
-
-    dates.append(today_iso.split()[0])
-    total_days += 1
-
-    # oops! some provinces are missing from the REST data?
-    for rec in data:
-        confirmed = rec['confirmed']
-        recovered = rec['recovered']
-        deaths = rec['deaths']
-        index = len(confirmed) - 1
-        if index == total_days - 1:
-            continue
-        confirmed.append(confirmed[index])
-        recovered.append(recovered[index])
-        deaths.append(deaths[index])
-
-    print('Fetching CSSE REST completed')
-
-def clean_us_data():
-    country = 'United States'
-    others_indices = []
-    n = len(data)
-    for i in range(0, n):
-        rec = data[i]
-        if rec['country'] != country:
-            continue
+def create_rest_delta(old, new):
+    # describe new REST features in terms of old ones; features are identified
+    # by their location, unchanged features by their old index only, and
+    # changed features by their old index and changed attributes
+    old_index = {}
+    for i, feature in enumerate(old):
+        old_index.setdefault(get_rest_feature_key(feature), i)
 
-        province = rec['province']
-        admin2 = rec['admin2']
-        if province not in dic.us_states.values():
-            # non-CONUS records
-            others_indices.append(i)
-            if not admin2:
-                rec['admin2'] = province
-            continue
-        elif admin2:
-            # CONUS admin2 records
+    features = []
+    used = set()
+    for feature in new:
+        i = old_index.get(get_rest_feature_key(feature))
+        if i is None or i in used or \
+           feature.keys() != old[i].keys() or \
+           feature['attributes'].keys() != old[i]['attributes'].keys():
+            # new feature
+            features.append({'feature': feature})
             continue
+        used.add(i)
 
-        # state-wide records
-        confirmed = rec['confirmed']
-        recovered = rec['recovered']
-        deaths = rec['deaths']
-
-        admin2_indices = []
-        for j in range(0, n):
-            rec2 = data[j]
-            if rec2['country'] == country and \
-               rec2['province'] == province and \
-               rec2['admin2']:
-                admin2_indices.append(j)
-                if rec2['admin2'] == 'Unassigned':
-                    rec2['latitude'] = rec['latitude']
-                    rec2['longitude'] = rec['longitude']
-
-        # no admin2 records
-        if not len(admin2_indices):
+        old_feature = old[i]
+        if feature == old_feature:
+            features.append(i)
             continue
+        change = {'from': i}
+        if feature.get('geometry') != old_feature.get('geometry'):
+            change['geometry'] = feature['geometry']
+        attributes = {key: value
+                      for key, value in feature['attributes'].items()
+                      if value != old_feature['attributes'][key]}
+        if attributes:
+            change['attributes'] = attributes
+        features.append(change)
+    return features
 
-        for j in range(0, len(confirmed)):
-            c = r = d = 0
-            for k in admin2_indices:
-                rec2 = data[k]
-                c += rec2['confirmed'][j]['count']
-                r += rec2['recovered'][j]['count']
-                d += rec2['deaths'][j]['count']
-            if c > confirmed[j]['count']:
-                print(f'US   confirmed: {province}, {country}, {dates[j]}, '
-                        f'{confirmed[j]["count"]} => {c}')
-                confirmed[j]['count'] = c
-            if r > recovered[j]['count']:
-                print(f'US   recovered: {province}, {country}, {dates[j]}, '
-                        f'{recovered[j]["count"]} => {r}')
-                recovered[j]['count'] = r
-            if d > deaths[j]['count']:
-                print(f'US   deaths   : {province}, {country}, {dates[j]}, '
-                        f'{deaths[j]["count"]} => {d}')
-                deaths[j]['count'] = d
-
-    latitude, longitude = geocode(country)
-
-    if len(others_indices):
-        confirmed = []
-        recovered = []
-        deaths = []
-        for i in range(0, total_days):
-            c = r = d = 0
-            last_updated = None
-            for j in others_indices:
-                rec = data[j]
-                time = rec['confirmed'][i]['time']
-                if last_updated is None or time > last_updated:
-                    last_updated = time
-                c += rec['confirmed'][i]['count']
-                r += rec['recovered'][i]['count']
-                d += rec['deaths'][i]['count']
-            confirmed.append({
-                'time': last_updated,
-                'count': c
-            })
-            recovered.append({
-                'time': last_updated,
-                'count': r
-            })
-            deaths.append({
-                'time': last_updated,
-                'count': d
-            })
-        province = 'Others'
-
-        print(f'US   confirmed: {province}, {country}, {c}')
-        print(f'US   recovered: {province}, {country}, {r}')
-        print(f'US   deaths   : {province}, {country}, {d}')
-
-        data.append({
-            'country': country,
-            'province': province,
-            'admin2': '',
-            'latitude': latitude,
-            'longitude': longitude,
-            'confirmed': confirmed,
-            'recovered': recovered,
-            'deaths': deaths
-        })
+def apply_rest_delta(old, delta):
+    features = []
+    for change in delta:
+        if isinstance(change, int):
+            features.append(old[change])
+        elif 'feature' in change:
+            features.append(change['feature'])
+        else:
+            feature = dict(old[change['from']])
+            if 'geometry' in change:
+                feature['geometry'] = change['geometry']
+            if 'attributes' in change:
+                feature['attributes'] = dict(feature['attributes'],
+                                             **change['attributes'])
+            features.append(feature)
+    return features
 
-    confirmed = []
-    recovered = []
-    deaths = []
-    for i in range(0, total_days):
-        c = r = d = 0
-        last_updated = None
-        for rec in data:
-            if rec['country'] == country and not rec['admin2']:
-                time = rec['confirmed'][i]['time']
-                if last_updated is None or time > last_updated:
-                    last_updated = time
-                c += rec['confirmed'][i]['count']
-                r += rec['recovered'][i]['count']
-                d += rec['deaths'][i]['count']
-        confirmed.append({
-            'time': last_updated,
-            'count': c
-        })
-        recovered.append({
-            'time': last_updated,
-            'count': r
-        })
-        deaths.append({
-            'time': last_updated,
-            'count': d
-        })
+def get_rest_snapshot_filename(name):
+    return f'{config.rest_history_dir}/{name}.json.gz'
+
+def list_rest_snapshots():
+    # snapshots are named after their UTC times, so they sort by time
+    return sorted(os.path.basename(x)[:-len('.json.gz')] for x in
+                  glob.glob(get_rest_snapshot_filename('*')))
+
+def read_rest_snapshot_file(name):
+    with gzip.open(get_rest_snapshot_filename(name)) as f:
+        return json.load(f)
+
+def read_rest_snapshot(as_of=None):
+    # reconstruct the last REST snapshot at or before as_of (a UTC datetime)
+    # from its last full snapshot and deltas after it; return its name, the
+    # number of deltas applied, and features
+    names = list_rest_snapshots()
+    if as_of:
+        names = names[:bisect.bisect_right(
+            names, as_of.strftime('%Y%m%dT%H%M%SZ'))]
+    if not names:
+        return None, 0, None
+
+    name = names[-1]
+    chain = [read_rest_snapshot_file(name)]
+    while 'base' in chain[-1]:
+        chain.append(read_rest_snapshot_file(chain[-1]['base']))
+    features = chain.pop()['features']
+    depth = len(chain)
+    while chain:
+        features = apply_rest_delta(features, chain.pop()['delta'])
+    return name, depth, features
+
+def write_rest_snapshot(features):
+    # record fetched REST features as a compressed delta against the previous
+    # snapshot or as a full snapshot every rest_history_full_interval
+    # snapshots to limit the number of files to read for reconstruction
+    name = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    base, depth, old_features = read_rest_snapshot()
+    if old_features == features or (base and name <= base):
+        return
+    if base and depth + 1 < config.rest_history_full_interval:
+        snapshot = {
+            'base': base,
+            'delta': create_rest_delta(old_features, features)
+        }
+    else:
+        snapshot = {'features': features}
+    os.makedirs(config.rest_history_dir, exist_ok=True)
+    replace_file(get_rest_snapshot_filename(name),
+                 gzip.compress(json.dumps(snapshot, separators=(',', ':')).
+                               encode(), compresslevel=9, mtime=0))
 
-    print(f'US   confirmed: {country}, {c}')
-    print(f'US   recovered: {country}, {r}')
-    print(f'US   deaths   : {country}, {d}')
-
-    data.append({
-        'country': country,
-        'province': '',
-        'admin2': '',
-        'latitude': latitude,
-        'longitude': longitude,
-        'confirmed': confirmed,
-        'recovered': recovered,
-        'deaths': deaths
-    })
+def save_rest_features(features):
+    write_file('data/csse_rest.json', json.dumps(features))
+    if config.rest_history_dir:
+        write_rest_snapshot(features)
 
 def get_data_filename(country, province=None):
     return 'data/' + (province + ', ' if province else '') + country + '.csv'
@@ -694,7 +901,7 @@ def get_data_filename(country, province=None):
 def fetch_kcdc_country():
     print('Fetching KCDC country...')
 
-    res = requests.get(kcdc_country_url).content.decode()
+    res = http_get('kcdc', kcdc_country_url).content.decode()
     m = re.search(kcdc_country_re, res, re.DOTALL)
     if not m:
         raise Exception('Fetching KCDC country failed')
@@ -734,12 +941,13 @@ def fetch_kcdc_country():
 def fetch_kcdc_provinces():
     print('Fetching KCDC provinces...')
 
-    if not kcdc_provinces_re:
+    if not kcdc_provinces_columns:
         print('Fetching KCDC provinces skipped')
         return
 
-    res = requests.get(kcdc_provinces_url).content.decode()
-    m = re.search(kcdc_provinces_re, res, re.DOTALL)
+    res = http_get('kcdc', kcdc_provinces_url).content.decode()
+    page = parse_html('kcdc', res)
+    m = re.search(kcdc_provinces_time_re, '\n'.join(page.texts))
     if not m:
         raise Exception('Fetching KCDC provinces 1/2 failed')
 
@@ -751,18 +959,20 @@ def fetch_kcdc_provinces():
     day = int(m[2])
     hour = int(m[3])
     last_updated_iso = f'{year}-{month:02}-{day:02} {hour:02}:00:00+09:00'
-    matches = re.findall(kcdc_provinces_subre, m[4])
-    if not matches:
+    columns, rows = find_table(page.tables, kcdc_provinces_columns, 'kcdc')
+    if not rows:
         raise Exception('Fetching KCDC provinces 2/2 failed')
 
     print('Fetching KCDC provinces 2/2 matched')
 
-    last_updated = None
-    for m in matches:
-        province = dic.en[m[0]]
-        confirmed = int(m[1].replace(',', ''))
-        recovered = int(m[2].replace(',', ''))
-        deaths = int(m[3].replace(',', ''))
+    for row in rows:
+        province = row[columns['province']]
+        if province == kcdc_provinces_total:
+            continue
+        province = dic.en[province]
+        confirmed = int(row[columns['confirmed']].replace(',', ''))
+        recovered = int(row[columns['recovered']].replace(',', ''))
+        deaths = int(row[columns['deaths']].replace(',', ''))
 
         filename = get_data_filename(country, province)
         add_header = True
@@ -788,17 +998,19 @@ def fetch_kcdc_provinces():
 def fetch_dxy():
     print('Fetching DXY...')
 
-    res = requests.get(dxy_url).content.decode()
-    m = re.search(dxy_re, res, re.DOTALL)
-    if not m:
+    res = http_get('dxy', dxy_url).content.decode()
+    page = parse_html('dxy', res)
+    countries = find_script_value(page.scripts, dxy_time_var)
+    areas = find_script_value(page.scripts, dxy_areas_var)
+    if not countries or areas is None:
         raise Exception('Fetching DXY failed')
 
     print('Fetching DXY matched')
 
-    last_updated = datetime.datetime.fromtimestamp(int(m[1])/1000,
-            tz=datetime.timezone.utc)
+    last_updated = datetime.datetime.fromtimestamp(
+            int(countries[0]['createTime'])/1000, tz=datetime.timezone.utc)
     last_updated_iso = last_updated.strftime('%Y-%m-%d %H:%M:%S+00:00')
-    for rec in json.loads(m[2]):
+    for rec in areas:
         province = rec['provinceShortName']
         if province not in dic.en:
             return
@@ -866,20 +1078,24 @@ def update_fetched_data(country, province, confirmed, recovered, deaths):
 def fetch_statistichecoronavirus():
     print('Fetching StatisticheCoronavirus...')
 
-    res = requests.get(statistichecoronavirus_url).content.decode(
-            errors='replace')
-    matches = re.findall(statistichecoronavirus_re, res, re.DOTALL)
-    if not matches:
+    res = http_get('statistichecoronavirus', statistichecoronavirus_url).\
+            content.decode(errors='replace')
+    page = parse_html('statistichecoronavirus', res)
+    columns, rows = find_table(page.tables, statistichecoronavirus_columns,
+                               'statistichecoronavirus')
+    if not rows:
         raise Exception('Fetching StatisticheCoronavirus failed')
 
     print('Fetching StatisticheCoronavirus matched')
 
     country = 'Italy'
-    for m in matches:
-        province = m[0]
-        confirmed = int(m[1].replace('.', ''))
-        recovered = int(m[3].replace('.', ''))
-        deaths = int(m[2].replace('.', ''))
+    for row in rows:
+        if not re.fullmatch('[0-9.]+', row[columns['confirmed']]):
+            continue
+        province = row[columns['province']]
+        confirmed = int(row[columns['confirmed']].replace('.', ''))
+        recovered = int(row[columns['recovered']].replace('.', ''))
+        deaths = int(row[columns['deaths']].replace('.', ''))
         update_fetched_data(country, province, confirmed, recovered, deaths)
 
     print('Fetching StatisticheCoronavirus completed')
@@ -892,136 +1108,851 @@ def strip_accents(s):
 def fetch_minsal():
     print('Fetching Minsal...')
 
-    res = requests.get(minsal_url).content.decode()
-    matches = re.findall(minsal_re, res, re.DOTALL)
-    if not matches:
+    res = http_get('minsal', minsal_url).content.decode()
+    page = parse_html('minsal', res)
+    columns, rows = find_table(page.tables, minsal_columns, 'minsal')
+    if not rows:
         raise Exception('Fetching Minsal 1/2 failed')
 
     print('Fetching Minsal 1/2 matched')
 
     country = 'Chile'
-    for m in matches:
-        province = strip_accents(m[0].replace('&#8217;', ''))
-        confirmed = int(m[1].replace('.', ''))
-        recovered = 0
-        deaths = int(m[2].replace('.', ''))
-        update_fetched_data(country, province, confirmed, recovered, deaths)
-
-    m = re.search(minsal_total_re, res, re.DOTALL)
-    if not m:
+    total = recovered_total = None
+    for row in rows:
+        province = row[columns['province']]
+        if province == minsal_total:
+            total = row
+        elif province.startswith(minsal_recovered):
+            recovered_total = row
+        elif re.fullmatch('[0-9.]+', row[columns['confirmed']]):
+            province = strip_accents(province.replace('\u2019', ''))
+            confirmed = int(row[columns['confirmed']].replace('.', ''))
+            recovered = 0
+            deaths = int(row[columns['deaths']].replace('.', ''))
+            update_fetched_data(country, province, confirmed, recovered,
+                                deaths)
+
+    if not total or not recovered_total:
         raise Exception('Fetching Minsal 2/2 failed')
 
     print('Fetching Minsal 2/2 matched')
 
     province = None
-    confirmed = int(m[1].replace('.', ''))
-    recovered = int(m[3].replace('.', ''))
-    deaths = int(m[2].replace('.', ''))
+    confirmed = int(total[columns['confirmed']].replace('.', ''))
+    recovered = int(next(x for x in recovered_total
+                         if re.fullmatch('[0-9.]+', x)).replace('.', ''))
+    deaths = int(total[columns['deaths']].replace('.', ''))
     update_fetched_data(country, province, confirmed, recovered, deaths)
 
     print('Fetching Minsal completed')
 
-def merge_local_data():
-    global total_days
+def convert_time(x):
+    if isinstance(x, datetime.datetime):
+        return int(x.timestamp())
+
+def create_time_axis(features):
+    # times of the longest series and the index of each series into them;
+    # series start on the UTC day of their first points as in
+    # Pipeline.align_series() or end on the last day if that day is not found
+    # because times are last updated times; same as readSeries() in
+    # covid-19-worker.js
+    time = []
+    for feature in features:
+        series = feature['properties']['confirmed']
+        if len(series) > len(time):
+            time = [x['time'] for x in series]
+    index = {}
+    for i, x in enumerate(time):
+        index.setdefault(x.toordinal(), i)
+    starts = []
+    for feature in features:
+        series = feature['properties']['confirmed']
+        start = index.get(series[0]['time'].toordinal())
+        if start is None or start + len(series) > len(time):
+            start = len(time) - len(series)
+        starts.append(start)
+    return time, starts
+
+def add_up_features(features, starts, time):
+    # add up series on the time axis from create_time_axis() from the first day
+    # to the last day of any of them; counts before the first day of a series
+    # are zeros and the last counts of a series that ends early are carried
+    # forward; same as addUpFeatures() in covid-19-worker.js
+    first = min(starts, default=0)
+    last = max((start + len(feature['properties']['confirmed'])
+                for feature, start in zip(features, starts)), default=0)
+    totals = {'time': time[first:last]}
+    for category in ('confirmed', 'recovered', 'deaths'):
+        counts = totals[category] = [0] * (last - first)
+        for feature, start in zip(features, starts):
+            series = feature['properties'][category]
+            k = start - first
+            for i, x in enumerate(series):
+                counts[k + i] += x['count']
+            for i in range(k + len(series), last - first):
+                counts[i] += series[-1]['count']
+    return totals
+
+def is_feature_displayed(country, province, admin2, has_duplicate_data):
+    # same as isFeatureDisplayed() in covid-19.js; the country-wide record and
+    # provinces, but only provinces in countries with duplicate data and only
+    # admin2 records in the United States
+    return not ((country == 'United States' and not admin2) or
+                (country != 'United States' and
+                 country in has_duplicate_data and not province))
+
+def get_total_features(features, starts, has_duplicate_data):
+    # add up displayed records only so that nothing is counted twice
+    total_features = []
+    total_starts = []
+    for feature, start in zip(features, starts):
+        prop = feature['properties']
+        if is_feature_displayed(prop['country'], prop['province'],
+                                prop['admin2'], has_duplicate_data):
+            total_features.append(feature)
+            total_starts.append(start)
+    return total_features, total_starts
+
+def calculate_country_totals(features, has_duplicate_data=()):
+    time, starts = create_time_axis(features)
+    return add_up_features(*get_total_features(features, starts,
+                                               has_duplicate_data), time)
+
+def create_geojson_delta(old, new):
+    # describe new features in terms of old ones; features are identified by
+    # their location and only changed data points are included
+    old_index = {}
+    for i, feature in enumerate(old['features']):
+        prop = feature['properties']
+        old_index[(prop['country'], prop['province'], prop['admin2'])] = i
 
-    for filename in glob.glob('data/*.csv'):
-        key = filename.replace('data/', '').replace('.csv', '')
-        if key.startswith('csse_'):
+    features = []
+    used = set()
+    for feature in new['features']:
+        prop = feature['properties']
+        i = old_index.get((prop['country'], prop['province'], prop['admin2']))
+        if i is None or i in used:
+            # new feature
+            features.append({'feature': feature})
             continue
-        country, province, admin2 = read_key(key)
+        used.add(i)
 
-        found = False
-        for rec in data:
-            if country == rec['country'] and \
-               province == rec['province'] and \
-               admin2 == rec['admin2']:
-                found = True
-                break
+        old_feature = old['features'][i]
+        change = {'from': i}
+        if feature['geometry'] != old_feature['geometry']:
+            change['geometry'] = feature['geometry']
+        for category in ('confirmed', 'recovered', 'deaths'):
+            series = prop[category]
+            old_series = old_feature['properties'][category]
+            changes = [[j, x['time'], x['count']]
+                       for j, x in enumerate(series)
+                       if j >= len(old_series) or x != old_series[j]]
+            if changes or len(series) != len(old_series):
+                change[category] = {
+                    'length': len(series),
+                    'changes': changes
+                }
+        features.append(change)
+
+    delta = {'features': features}
+    members = {key: value for key, value in new.items()
+               if key not in ('type', 'features') and old.get(key) != value}
+    if members:
+        delta['members'] = members
+    return delta
+
+def round_cfr(cfr_fraction):
+    # same as roundCFR() in covid-19.js
+    return math.floor(cfr_fraction * 1000 + 0.5) / 10
+
+def calculate_derived_metrics(confirmed, recovered, deaths):
+    # daily increases, their rolling averages, and case fatality ratios from
+    # cumulative counts; counts before the first day are zeros
+    n = len(confirmed)
+    average_days = config.rolling_average_days
+    cfr_days = config.average_days_from_confirmed_to_death
+    metrics = {'increase': {}, 'average_increase': {}}
+    for category, counts in (('confirmed', confirmed),
+                             ('recovered', recovered),
+                             ('deaths', deaths)):
+        metrics['increase'][category] = [
+            x - y for x, y in zip(counts, [0] + counts[:-1])]
+        # the sum of increases over the last days is the difference in
+        # cumulative counts
+        metrics['average_increase'][category] = [
+            round((x - y) / average_days, 1)
+            for x, y in zip(counts, ([0] * average_days + counts)[:n])]
+    metrics['cfr_t'] = [
+        round_cfr(d / c) if c else None
+        for d, c in zip(deaths, ([0] * cfr_days + confirmed)[:n])]
+    metrics['cfr_ddr'] = [
+        round_cfr(d / (d + r)) if d + r else None
+        for r, d in zip(recovered, deaths)]
+    return metrics
+
+def create_derived_metrics(features, totals=None, has_duplicate_data=()):
+    # derived metrics for each feature, each country, and all countries or the
+    # country totals
+    feature_metrics = []
+    countries = {}
+    time, starts = create_time_axis(features)
+    for feature, start in zip(features, starts):
+        prop = feature['properties']
+        feature_metrics.append(calculate_derived_metrics(
+            *([x['count'] for x in prop[category]]
+              for category in ('confirmed', 'recovered', 'deaths'))))
+        country_features, country_starts = countries.setdefault(
+                prop['country'], ([], []))
+        country_features.append(feature)
+        country_starts.append(start)
+
+    country_metrics = {}
+    total_features = []
+    total_starts = []
+    for country, (country_features, country_starts) in countries.items():
+        country_features, country_starts = get_total_features(
+                country_features, country_starts, has_duplicate_data)
+        country_totals = add_up_features(country_features, country_starts,
+                                         time)
+        country_metrics[country] = calculate_derived_metrics(
+            country_totals['confirmed'], country_totals['recovered'],
+            country_totals['deaths'])
+        total_features.extend(country_features)
+        total_starts.extend(country_starts)
+
+    total = totals or add_up_features(total_features, total_starts, time)
+    return {
+        'rolling_average_days': config.rolling_average_days,
+        'average_days_from_confirmed_to_death':
+            config.average_days_from_confirmed_to_death,
+        'features': feature_metrics,
+        'countries': country_metrics,
+        'total': calculate_derived_metrics(total['confirmed'],
+                                           total['recovered'],
+                                           total['deaths'])
+    }
 
-        if found:
-            confirmed = rec['confirmed']
-            recovered = rec['recovered']
-            deaths = rec['deaths']
-            index = len(confirmed) - 1
-            time = confirmed[index]['time']
+def create_search_index(features):
+    # names of features as matched by showFeatureStatsByQuery() in covid-19.js
+    # with their hierarchy levels (0 for countries, 1 for provinces, and 2 for
+    # admin2), the features with each name, and the names containing each
+    # trigram for substring lookups; same as createSearchIndex() in
+    # covid-19-worker.js
+    index = {'names': [], 'levels': [], 'features': [], 'trigrams': {}}
+    entries = {}
+    for feature in features:
+        prop = feature['properties']
+        name = ', '.join((prop['admin2'], prop['province'], prop['country']))
+        if name not in entries:
+            entry = entries[name] = len(index['names'])
+            index['names'].append(name)
+            index['levels'].append(2 if prop['admin2'] else
+                                   1 if prop['province'] else 0)
+            index['features'].append([])
+            # sorted for the same output from the same features
+            for trigram in sorted({name[i:i+3]
+                                   for i in range(len(name) - 2)}):
+                index['trigrams'].setdefault(trigram, []).append(entry)
+        index['features'][entries[name]].append(feature['id'])
+    return index
+
+def get_binary_filename(filename):
+    return f'{os.path.splitext(filename)[0]}.bin'
+
+def get_metrics_filename(filename):
+    return f'{os.path.splitext(filename)[0]}-metrics.json'
+
+def get_search_index_filename(filename):
+    return f'{os.path.splitext(filename)[0]}-search.json'
+
+def get_full_filename(filename):
+    return f'{os.path.splitext(filename)[0]}-full.json'
+
+def downsample_features(features, daily_days):
+    # keep the last days at daily resolution and only the last day of each week
+    # before them; days are cut on the time axis of all the features so that
+    # they keep the same days, and the last point of each series is always kept;
+    # also return the first time at daily resolution
+    time, starts = create_time_axis(features)
+    cutoff = max(len(time) - daily_days, 0)
+    downsampled = []
+    for feature, start in zip(features, starts):
+        prop = feature['properties']
+        n = len(prop['confirmed'])
+        kept = [i for i in range(n)
+                if start + i >= cutoff or (cutoff - 1 - start - i) % 7 == 0 or
+                   i == n - 1]
+        prop = dict(prop, **{
+            category: [prop[category][i] for i in kept]
+            for category in ('confirmed', 'recovered', 'deaths')})
+        downsampled.append(dict(feature, properties=prop))
+    return downsampled, time[cutoff] if cutoff < len(time) else None
+
+def create_binary_data(features, totals=None):
+    # a header length, a JSON header padded to four bytes, and little-endian
+    # Int32 counts laid out by feature, category, and day; each series starts
+    # at its own index into the time axis from create_time_axis()
+    time, starts = create_time_axis(features)
+    header_features = []
+    counts = array.array('i')
+    for feature, start in zip(features, starts):
+        prop = feature['properties']
+        n = len(prop['confirmed'])
+        header_features.append({
+            'country': prop['country'],
+            'province': prop['province'],
+            'admin2': prop['admin2'],
+            'coordinates': feature['geometry']['coordinates'],
+            'updated': prop['confirmed'][n - 1]['time'],
+            'offset': len(counts),
+            'start': start,
+            'length': n
+        })
+        for category in ('confirmed', 'recovered', 'deaths'):
+            counts.extend(x['count'] for x in prop[category])
+    if sys.byteorder == 'big':
+        counts.byteswap()
+
+    header = {'time': time, 'features': header_features}
+    if totals:
+        header['totals'] = totals
+    header = json.dumps(header, default=convert_time,
+                        separators=(',', ':')).encode()
+    header += b' ' * (-len(header) % 4)
+    return struct.pack('<I', len(header)) + header + counts.tobytes()
+
+def create_npy(descr, shape, content):
+    # NumPy's .npy format version 1.0 so that numpy.load() can read arrays
+    # without NumPy here
+    header = repr({'descr': descr, 'fortran_order': False, 'shape': shape})
+    header = header.encode() + b' ' * (63 - (10 + len(header)) % 64) + b'\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header + \
+           content
+
+def create_int_npy(typecode, descr, values, shape=None):
+    values = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return create_npy(descr, shape or (len(values),), values.tobytes())
+
+def create_str_npy(values):
+    # fixed-width UTF-32 strings
+    width = max((len(x) for x in values), default=0) or 1
+    return create_npy(f'<U{width}', (len(values),), b''.join(
+        x.ljust(width, '\0').encode('utf-32-le') for x in values))
+
+def create_npz(arrays):
+    # like numpy.savez_compressed(), but with fixed timestamps so that
+    # unchanged data produces identical files
+    with io.BytesIO() as f:
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as z:
+            for name, content in arrays.items():
+                info = zipfile.ZipInfo(f'{name}.npy', (1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                z.writestr(info, content)
+        return f.getvalue()
+
+def find_runs(flags):
+    # start and end indices of consecutive true flags
+    runs = []
+    start = None
+    for i, flag in enumerate(flags):
+        if flag and start is None:
+            start = i
+        elif not flag and start is not None:
+            runs.append((start, i - 1))
+            start = None
+    if start is not None:
+        runs.append((start, len(flags) - 1))
+    return runs
+
+def create_anomaly(anomaly_type, rec, category, start, end, **kwargs):
+    return {
+        'type': anomaly_type,
+        'country': rec['country'],
+        'province': rec['province'],
+        'admin2': rec['admin2'],
+        'category': category,
+        'start': start,
+        'end': end,
+        **kwargs
+    }
 
-            with open(filename) as f:
-                reader = csv.reader(f)
-                for row in reader:
-                    pass
-                last_updated = datetime.datetime.fromisoformat(row[0]).\
-                        astimezone(datetime.timezone.utc)
+def copy_record(rec):
+    return dict(rec, **{category: list(rec[category])
+                        for category in ('confirmed', 'recovered', 'deaths')})
+
+def replace_point(series, index, **changes):
+    # points can be shared between days; replace them in all those days instead
+    # of changing them so that copies of the series keep theirs
+    point = series[index]
+    new_point = dict(point, **changes)
+    while index >= 0 and series[index] is point:
+        series[index] = new_point
+        index -= 1
+
+class Pipeline:
+    def __init__(self, countries_to_display=None):
+        # all the records and their dates; countries other than
+        # countries_to_display are dropped while ingesting data
+        self.dates = []
+        self.data = []
+        self.key2data = {}
+        # records by country, province, and admin2; see add_record()
+        self.locations = {}
+        self.has_duplicate_data = []
+        self.total_days = 0
+        self.countries_to_display = tuple(config.countries_to_display
+                if countries_to_display is None else countries_to_display)
+        # content hashes of written outputs
+        self.output_hashes = {}
+
+    def index_record(self, rec):
+        self.locations.setdefault(rec['country'], {}).\
+                setdefault(rec['province'], {}).\
+                setdefault(rec['admin2'], []).append(rec)
+
+    def add_record(self, rec):
+        # always add records through here to keep them indexed
+        self.data.append(rec)
+        self.index_record(rec)
+
+    def find_record(self, country, province='', admin2=''):
+        # the first record added for the location
+        recs = self.locations.get(country, {}).get(province, {}).get(admin2)
+        return recs[0] if recs else None
+
+    def copy(self):
+        # records and their series are copied, but their points are shared;
+        # later steps replace points instead of changing them
+        pipeline = copy.copy(self)
+        pipeline.dates = list(self.dates)
+        pipeline.data = []
+        pipeline.key2data = dict(self.key2data)
+        pipeline.locations = {}
+        pipeline.has_duplicate_data = list(self.has_duplicate_data)
+        pipeline.output_hashes = {}
+        for rec in self.data:
+            pipeline.add_record(copy_record(rec))
+        return pipeline
+
+    def restore_countries(self, base, countries):
+        # replace the records of countries with copies of those in base before
+        # merging their local data again; key2data is only used while merging
+        # CSSE data into base
+        self.data = [rec for rec in self.data
+                     if rec['country'] not in countries]
+        for country in countries:
+            self.locations.pop(country, None)
+            for rec in base.find_records(country):
+                self.add_record(copy_record(rec))
+        self.has_duplicate_data = [
+            country for country in self.has_duplicate_data
+            if country not in countries or
+               country in base.has_duplicate_data]
+
+    def find_records(self, country, province=None):
+        # all the records in the country or province
+        provinces = self.locations.get(country, {})
+        if province is not None:
+            provinces = {province: provinces.get(province, {})}
+        for admin2s in provinces.values():
+            for recs in admin2s.values():
+                yield from recs
+
+    def fetch_csse_csv(self, daily_dates=None, daily_cache=None, resume=False):
+        print('Fetching CSSE CSV...')
+
+        if daily_dates is None:
+            daily_dates = fetch_csse_daily_dates()
+        if daily_cache is None:
+            daily_cache = {}
+        if resume and config.checkpoint_dir:
+            # skip daily reports parsed by a previous run except for the latest
+            # one, which can be revised
+            for date in daily_dates[1:]:
+                if date not in daily_cache:
+                    parsed = read_checkpoint(date, self.countries_to_display)
+                    if parsed:
+                        daily_cache[date] = parsed
+
+        # parse daily reports that are not cached yet in worker processes;
+        # map() returns partial results in order, so merging them is
+        # deterministic
+        missing = [date for date in daily_dates if date not in daily_cache]
+        parse = functools.partial(call_with_latencies, parse_csse_daily_csv,
+                countries_to_display=self.countries_to_display)
+        if config.parse_processes == 1 or not missing:
+            parsed = map(parse, missing)
+            pool = None
+        else:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                    config.parse_processes, initializer=init_worker)
+            parsed = pool.map(parse, missing, chunksize=4)
+
+        j = 0
+        try:
+            for date in daily_dates:
+                if date not in daily_cache:
+                    daily_cache[date], new_latencies = next(parsed)
+                    add_latencies(new_latencies)
+                    if config.checkpoint_dir:
+                        write_checkpoint(date, daily_cache[date],
+                                         self.countries_to_display)
+                date_iso, records = daily_cache[date]
+                self.dates.insert(0, date_iso)
+
+                print(f'{date_iso}...', end='', flush=True)
+                j += 1
+                if j % 5 == 0:
+                    print('')
+
+                self.merge_csse_daily_csv(date_iso, records)
+                self.total_days += 1
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+        if j % 5:
+            print('')
+
+        for rec in self.data:
+            for category in ('confirmed', 'recovered', 'deaths'):
+                i = 0
+                insert = {}
+                for x in rec[category]:
+                    date = x['time'].strftime('%Y-%m-%d')
+                    while i < self.total_days - 1 and self.dates[i] < date:
+                        insert[i] = {
+                            'time': datetime.datetime.fromisoformat(
+                                f'{self.dates[i]} 23:59:59+00:00'),
+                            'count': 0,
+                        }
+                        i += 1
+                    i += 1
+                for key in sorted(insert.keys()):
+                    rec[category].insert(key, insert[key])
+                index = len(rec[category]) - 1
+                while i < self.total_days:
+                    # TODO: aggregate
+                    rec[category].append({
+                        'time': datetime.datetime.fromisoformat(
+                            f'{self.dates[i]} 23:59:59+00:00'),
+                        'count': rec[category][index]['count']
+                    })
+                    i += 1
+
+        print('Fetching CSSE CSV completed')
+
+    def merge_csse_daily_csv(self, date_iso, records):
+        last_updated = datetime.datetime.fromisoformat(
+                f'{date_iso} 23:59:59+00:00')
+        date_csv = f'{date_iso[5:7]}-{date_iso[8:10]}-{date_iso[:4]}'
+
+        for key, (country, province, admin2, latitude, longitude, c, r, d) in \
+                records.items():
+            if latitude and longitude:
+                add_to_gazetteer(country, province, admin2, latitude,
+                                 longitude)
+            if key in dic.latlong:
+                latlong = dic.latlong[key]
+                latitude = latlong['latitude']
+                longitude = latlong['longitude']
+            if not latitude or not longitude:
+                latitude, longitude = geocode(country, province, admin2)
+                if not latitude or not longitude:
+                    raise Exception('Latitude or longitude is not defined for '
+                            f'{key} in {date_csv}')
+            if key not in self.key2data:
+                if self.total_days > 0 and \
+                   (country != 'United States' or
+                    province not in dic.us_states.values() or
+                    admin2 == 'Unassigned'):
+                    continue
+                # new record not in data
+                index = len(self.data)
+                self.key2data[key] = index
+                # create and populate three lists with time series data
+                confirmed = []
+                recovered = []
+                deaths = []
+                self.add_record({
+                    'country': country,
+                    'province': province,
+                    'admin2': admin2,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'confirmed': confirmed,
+                    'recovered': recovered,
+                    'deaths': deaths
+                })
+            else:
+                # retrieve existing lists
+                index = self.key2data[key]
+                rec = self.data[index]
+                confirmed = rec['confirmed']
+                recovered = rec['recovered']
+                deaths = rec['deaths']
+
+            confirmed.insert(0, {
+                'time': last_updated,
+                'count': c
+            })
+            recovered.insert(0, {
+                'time': last_updated,
+                'count': r
+            })
+            deaths.insert(0, {
+                'time': last_updated,
+                'count': d
+            })
+
+    def fetch_csse_rest(self, features=None):
+        print('Fetching CSSE REST...')
+
+        if features is None:
+            features = fetch_all_features(features_url)
+            save_rest_features(features)
+
+        today_iso = datetime.datetime.utcnow().strftime(
+                '%Y-%m-%d 00:00:00+00:00')
+        today = datetime.datetime.fromisoformat(today_iso)
+
+        # try to find most up-to-date info from the REST server
+        for feature in features:
+            attr = feature['attributes']
+            c = int(attr['Confirmed'])
+            r = int(attr['Recovered'])
+            d = int(attr['Deaths'])
+
+            if c + r + d == 0:
+                continue
+
+            country = attr['Country_Region'].strip()
+            if country in dic.co_names:
+                country = dic.co_names[country]
+            province = attr['Province_State'].strip() \
+                if attr['Province_State'] else ''
+            admin2 = attr['Admin2'].strip() if attr['Admin2'] else ''
+            last_updated = datetime.datetime.fromtimestamp(
+                    attr['Last_Update']/1000, tz=datetime.timezone.utc)
+            # sometimes, the last date in the CSV file is later than REST; in
+            # this case, let's use today's time at 00:00:00
+            if today > last_updated:
+                last_updated = today
+            if 'geometry' in feature:
+                latitude = feature['geometry']['y']
+                longitude = feature['geometry']['x']
+
+            key = generate_key(country, province, admin2)
+            if key in dic.keymap:
+                key = dic.keymap[key]
+                country, province, admin2 = read_key(key)
+            if not is_country_to_display(country, self.countries_to_display):
+                continue
+            if 'geometry' in feature:
+                add_to_gazetteer(country, province, admin2, latitude,
+                                 longitude)
+            if key in dic.latlong:
+                latlong = dic.latlong[key]
+                latitude = latlong['latitude']
+                longitude = latlong['longitude']
+            if not latitude or not longitude:
+                latitude, longitude = geocode(country, province, admin2)
+                if not latitude or not longitude:
+                    raise Exception('Latitude or longitude is not defined for '
+                            f'{key} in {date_csv}')
+            if key not in self.key2data:
+                # new record not in data
+                index = len(self.data)
+                self.key2data[key] = index
+                # create and populate three lists with REST data
+                confirmed = copy.deepcopy(self.data[0]['confirmed'])
+                recovered = copy.deepcopy(self.data[0]['recovered'])
+                deaths = copy.deepcopy(self.data[0]['deaths'])
+                if len(confirmed) > self.total_days:
+                    index = len(confirmed) - 1
+                    del confirmed[index], recovered[index], deaths[index]
+                for i in range(0, self.total_days):
+                    confirmed[i]['count'] = recovered[i]['count'] = \
+                    deaths[i]['count'] = 0
+                self.add_record({
+                    'country': country,
+                    'province': province,
+                    'admin2': admin2,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'confirmed': confirmed,
+                    'recovered': recovered,
+                    'deaths': deaths
+                })
+
+                if c:
+                    print(f'REST confirmed: {admin2}, {province}, {country}, '
+                            f'0 => {c}')
+                if r:
+                    print(f'REST recovered: {admin2}, {province}, {country}, '
+                            f'0 => {r}')
+                if d:
+                    print(f'REST deaths   : {admin2}, {province}, {country}, '
+                            f'0 => {d}')
+            else:
+                # retrieve existing lists
+                index = self.key2data[key]
+                rec = self.data[index]
+                country = rec['country']
+                province = rec['province']
+                admin2 = rec['admin2']
+                confirmed = rec['confirmed']
+                recovered = rec['recovered']
+                deaths = rec['deaths']
+                time = confirmed[len(confirmed) - 1]['time']
+                # I found this case where a time from the spreadsheet is more
+                # recent than the last updated time from the REST server
                 if time > last_updated:
                     last_updated = time
-                c = int(row[1])
-                r = int(row[2])
-                d = int(row[3])
-                if c > confirmed[index]['count']:
-                    print(f'data confirmed: {province}, {country}, '
+
+                index = len(confirmed) - 1
+                c = max(confirmed[index]['count'], c)
+                r = max(recovered[index]['count'], r)
+                d = max(deaths[index]['count'], d)
+                if c != confirmed[index]['count']:
+                    print(f'REST confirmed: {admin2}, {province}, {country}, '
                             f'{confirmed[index]["count"]} => {c}')
-                    confirmed[index] = {
-                        'time': last_updated,
-                        'count': c
-                    }
-                if r > recovered[index]['count']:
-                    print(f'data recovered: {province}, {country}, '
+                if r != recovered[index]['count']:
+                    print(f'REST recovered: {admin2}, {province}, {country}, '
                             f'{recovered[index]["count"]} => {r}')
-                    recovered[index] = {
-                        'time': last_updated,
-                        'count': r
-                    }
-                if d > deaths[index]['count']:
-                    print(f'data deaths   : {province}, {country}, '
+                if d != deaths[index]['count']:
+                    print(f'REST deaths   : {admin2}, {province}, {country}, '
                             f'{deaths[index]["count"]} => {d}')
-                    deaths[index] = {
-                        'time': last_updated,
-                        'count': d
-                    }
-        else:
-            if province and country not in has_duplicate_data:
-                has_duplicate_data.append(country)
 
-            latitude, longitude = geocode(country, province, admin2)
+            if len(confirmed) == self.total_days + 1:
+                continue
+
+            confirmed.append({
+                'time': last_updated,
+                'count': c
+            }),
+            recovered.append({
+                'time': last_updated,
+                'count': r
+            }),
+            deaths.append({
+                'time': last_updated,
+                'count': d
+            })
 
+        self.dates.append(today_iso.split()[0])
+        self.total_days += 1
+
+        # oops! some provinces are missing from the REST data?
+        for rec in self.data:
+            confirmed = rec['confirmed']
+            recovered = rec['recovered']
+            deaths = rec['deaths']
+            index = len(confirmed) - 1
+            if index == self.total_days - 1:
+                continue
+            confirmed.append(confirmed[index])
+            recovered.append(recovered[index])
+            deaths.append(deaths[index])
+
+        print('Fetching CSSE REST completed')
+
+    def clean_us_data(self):
+        country = 'United States'
+        if not is_country_to_display(country, self.countries_to_display):
+            return
+
+        others = []
+        for rec in list(self.find_records(country)):
+            province = rec['province']
+            admin2 = rec['admin2']
+            if province not in dic.us_states.values():
+                # non-CONUS records
+                others.append(rec)
+                if not admin2:
+                    rec['admin2'] = province
+                    self.locations[country][province][''].remove(rec)
+                    self.index_record(rec)
+                continue
+            elif admin2:
+                # CONUS admin2 records
+                continue
+
+            # state-wide records
+            confirmed = rec['confirmed']
+            recovered = rec['recovered']
+            deaths = rec['deaths']
+
+            admin2_recs = []
+            for rec2 in self.find_records(country, province):
+                if rec2['admin2']:
+                    admin2_recs.append(rec2)
+                    if rec2['admin2'] == 'Unassigned':
+                        rec2['latitude'] = rec['latitude']
+                        rec2['longitude'] = rec['longitude']
+
+            # no admin2 records
+            if not len(admin2_recs):
+                continue
+
+            for j in range(0, len(confirmed)):
+                c = r = d = 0
+                for rec2 in admin2_recs:
+                    c += rec2['confirmed'][j]['count']
+                    r += rec2['recovered'][j]['count']
+                    d += rec2['deaths'][j]['count']
+                if c > confirmed[j]['count']:
+                    print(f'US   confirmed: {province}, {country}, '
+                            f'{self.dates[j]}, {confirmed[j]["count"]} => {c}')
+                    confirmed[j]['count'] = c
+                if r > recovered[j]['count']:
+                    print(f'US   recovered: {province}, {country}, '
+                            f'{self.dates[j]}, {recovered[j]["count"]} => {r}')
+                    recovered[j]['count'] = r
+                if d > deaths[j]['count']:
+                    print(f'US   deaths   : {province}, {country}, '
+                            f'{self.dates[j]}, {deaths[j]["count"]} => {d}')
+                    deaths[j]['count'] = d
+
+        latitude, longitude = geocode(country)
+
+        if len(others):
             confirmed = []
             recovered = []
             deaths = []
+            for i in range(0, self.total_days):
+                c = r = d = 0
+                last_updated = None
+                for rec in others:
+                    time = rec['confirmed'][i]['time']
+                    if last_updated is None or time > last_updated:
+                        last_updated = time
+                    c += rec['confirmed'][i]['count']
+                    r += rec['recovered'][i]['count']
+                    d += rec['deaths'][i]['count']
+                confirmed.append({
+                    'time': last_updated,
+                    'count': c
+                })
+                recovered.append({
+                    'time': last_updated,
+                    'count': r
+                })
+                deaths.append({
+                    'time': last_updated,
+                    'count': d
+                })
+            province = 'Others'
 
-            with open(filename) as f:
-                reader = csv.reader(f)
-                reader.__next__()
-                for row in reader:
-                    time = datetime.datetime.fromisoformat(row[0]).\
-                            astimezone(datetime.timezone.utc)
-                    if config.use_local_data_only:
-                        date = time.strftime('%Y-%m-%d')
-                        if date not in dates:
-                            dates.append(date)
-
-                    c = int(row[1])
-                    r = int(row[2])
-                    d = int(row[3])
-                    confirmed.append({
-                        'time': time,
-                        'count': c
-                    })
-                    recovered.append({
-                        'time': time,
-                        'count': r
-                    })
-                    deaths.append({
-                        'time': time,
-                        'count': d
-                    })
-
-            print(f'data confirmed: {admin2}, {province}, {country}, {c}')
-            print(f'data recovered: {admin2}, {province}, {country}, {r}')
-            print(f'data deaths   : {admin2}, {province}, {country}, {d}')
+            print(f'US   confirmed: {province}, {country}, {c}')
+            print(f'US   recovered: {province}, {country}, {r}')
+            print(f'US   deaths   : {province}, {country}, {d}')
 
-            data.append({
+            self.add_record({
                 'country': country,
                 'province': province,
-                'admin2': admin2,
+                'admin2': '',
                 'latitude': latitude,
                 'longitude': longitude,
                 'confirmed': confirmed,
@@ -1029,104 +1960,41 @@ def merge_local_data():
                 'deaths': deaths
             })
 
-    if config.use_local_data_only:
-        dates.sort()
-        total_days = len(dates)
-
-    for country in has_duplicate_data:
-        total_confirmed = total_recovered = total_deaths = 0
-        co_confirmed = co_recovered = co_deaths = 0
-        co_rec = None
-        last_updated = None
-        for rec in data:
-            co = rec['country']
-            if co != country:
-                continue
-            province = rec['province']
-            confirmed = rec['confirmed']
-            recovered = rec['recovered']
-            deaths = rec['deaths']
-            index = len(confirmed) - 1
-            time = confirmed[index]['time']
-            c = confirmed[index]['count']
-            r = recovered[index]['count']
-            d = deaths[index]['count']
-            if province:
-                if not last_updated or time > last_updated:
-                    last_updated = time
-                total_confirmed += c
-                total_recovered += r
-                total_deaths += d
-            else:
-                co_rec = rec
-                co_last_updated = time
-                co_confirmed = c
-                co_recovered = r
-                co_deaths = d
-
-        if co_confirmed == total_confirmed and \
-           co_recovered == total_recovered and \
-           co_deaths == total_deaths:
-            # remote data is exactly the same as local data
-            continue
+        confirmed = []
+        recovered = []
+        deaths = []
+        for i in range(0, self.total_days):
+            c = r = d = 0
+            last_updated = None
+            for rec in self.find_records(country):
+                if not rec['admin2']:
+                    time = rec['confirmed'][i]['time']
+                    if last_updated is None or time > last_updated:
+                        last_updated = time
+                    c += rec['confirmed'][i]['count']
+                    r += rec['recovered'][i]['count']
+                    d += rec['deaths'][i]['count']
+            confirmed.append({
+                'time': last_updated,
+                'count': c
+            })
+            recovered.append({
+                'time': last_updated,
+                'count': r
+            })
+            deaths.append({
+                'time': last_updated,
+                'count': d
+            })
 
-        index = len(co_rec['confirmed']) - 1
-        c = r = d = 0
-        if last_updated > co_last_updated:
-            # local data is newer
-            co_rec['confirmed'][index]['time'] = \
-            co_rec['recovered'][index]['time'] = \
-            co_rec['deaths'][index]['time'] = last_updated
-        else:
-            # remote data is newer
-            last_updated = co_last_updated
-
-        # be conservative!
-        if co_confirmed > total_confirmed:
-            c = co_confirmed - total_confirmed
-        elif total_confirmed > co_confirmed:
-            print(f'data confirmed: {country}, {co_confirmed} => '
-                    f'{total_confirmed}')
-            co_rec['confirmed'][index]['count'] = total_confirmed
-        if co_recovered > total_recovered:
-            r = co_recovered - total_recovered
-        elif total_recovered > co_recovered:
-            print(f'data recovered: {country}, {co_recovered} => '
-                    f'{total_recovered}')
-            co_rec['recovered'][index]['count'] = total_recovered
-        if co_deaths > total_deaths:
-            d = co_deaths - total_deaths
-        elif total_deaths > co_deaths:
-            print(f'data deaths   : {country}, {co_deaths} => {total_deaths}')
-            co_rec['deaths'][index]['count'] = total_deaths
-
-        if c + r + d == 0:
-            continue
+        print(f'US   confirmed: {country}, {c}')
+        print(f'US   recovered: {country}, {r}')
+        print(f'US   deaths   : {country}, {d}')
 
-        province = 'Others'
-        latitude = co_rec['latitude']
-        longitude = co_rec['longitude']
-
-        print(f'data confirmed: {province}, {country}, {c}')
-        print(f'data recovered: {province}, {country}, {r}')
-        print(f'data deaths   : {province}, {country}, {d}')
-
-        confirmed = [{
-            'time': last_updated,
-            'count': c
-        }]
-        recovered = [{
-            'time': last_updated,
-            'count': r
-        }]
-        deaths = [{
-            'time': last_updated,
-            'count': d
-        }]
-        data.append({
+        self.add_record({
             'country': country,
-            'province': province,
-            'admin2': admin2,
+            'province': '',
+            'admin2': '',
             'latitude': latitude,
             'longitude': longitude,
             'confirmed': confirmed,
@@ -1134,97 +2002,393 @@ def merge_local_data():
             'deaths': deaths
         })
 
-def sort_data():
-    # sort records by confirmed, country, and province
-    data.sort(key=lambda x: (
-        -x['confirmed'][len(x['confirmed'])-1]['count'],
-        x['country'],
-        x['province']))
-
-def report_data():
-    total_confirmed = total_recovered = total_deaths = 0
-    for rec in data:
-        country = rec['country']
-        province = rec['province']
-        admin2 = rec['admin2']
-        latitude = rec['latitude']
-        longitude = rec['longitude']
-        index = len(rec['confirmed']) - 1
-        c = rec['confirmed'][index]['count']
-        r = rec['recovered'][index]['count']
-        d = rec['deaths'][index]['count']
-        if c + r + d == 0 or \
-           (country in has_duplicate_data and not province) or \
-           (country == 'United States' and not admin2):
-            continue
-        print(f'final: {admin2}, {province}, {country}, '
-                f'{latitude}, {longitude}, {c}, {r}, {d}')
-        total_confirmed += c
-        total_recovered += r
-        total_deaths += d
-
-    print(f'Total confirmed: {total_confirmed}')
-    print(f'Total recovered: {total_recovered}')
-    print(f'Total deaths   : {total_deaths}')
-
-def write_geojson():
-    # create a new list to store all the features
-    features = []
-    # create a feature collection
-    feature_id = 0
-    for rec in data:
-        country = rec['country']
-        province = rec['province']
-        admin2 = rec['admin2']
-        index = len(rec['confirmed']) - 1
-        if (rec['confirmed'][index]['count'] +
-            rec['recovered'][index]['count'] +
-            rec['deaths'][index]['count'] == 0) or \
-           (has_countries_to_display and
-            country not in config.countries_to_display):
-            continue
-        features.append({
-            'id': feature_id,
-            'type': 'Feature',
-            'geometry': {
-                'type': 'Point',
-                'coordinates': [
-                    round(rec['longitude'], 4),
-                    round(rec['latitude'], 4)
-                ]
-            },
-            'properties': {
+    def merge_local_data(self, countries=None):
+        # merge local data for all the countries or only for countries
+        for filename in glob.glob('data/*.csv'):
+            key = filename.replace('data/', '').replace('.csv', '')
+            if key.startswith('csse_'):
+                continue
+            country, province, admin2 = read_key(key)
+            if not is_country_to_display(country,
+                                         self.countries_to_display) or \
+               (countries is not None and country not in countries):
+                continue
+
+            rec = self.find_record(country, province, admin2)
+            if rec:
+                confirmed = rec['confirmed']
+                recovered = rec['recovered']
+                deaths = rec['deaths']
+                index = len(confirmed) - 1
+                time = confirmed[index]['time']
+
+                with open_csv(filename) as reader:
+                    for row in reader:
+                        pass
+                    last_updated = datetime.datetime.fromisoformat(row[0]).\
+                            astimezone(datetime.timezone.utc)
+                    if time > last_updated:
+                        last_updated = time
+                    c = int(row[1])
+                    r = int(row[2])
+                    d = int(row[3])
+                    if c > confirmed[index]['count']:
+                        print(f'data confirmed: {province}, {country}, '
+                                f'{confirmed[index]["count"]} => {c}')
+                        confirmed[index] = {
+                            'time': last_updated,
+                            'count': c
+                        }
+                    if r > recovered[index]['count']:
+                        print(f'data recovered: {province}, {country}, '
+                                f'{recovered[index]["count"]} => {r}')
+                        recovered[index] = {
+                            'time': last_updated,
+                            'count': r
+                        }
+                    if d > deaths[index]['count']:
+                        print(f'data deaths   : {province}, {country}, '
+                                f'{deaths[index]["count"]} => {d}')
+                        deaths[index] = {
+                            'time': last_updated,
+                            'count': d
+                        }
+            else:
+                if province and country not in self.has_duplicate_data:
+                    self.has_duplicate_data.append(country)
+
+                latitude, longitude = geocode(country, province, admin2)
+
+                confirmed = []
+                recovered = []
+                deaths = []
+
+                with open_csv(filename) as reader:
+                    reader.__next__()
+                    for row in reader:
+                        time = datetime.datetime.fromisoformat(row[0]).\
+                                astimezone(datetime.timezone.utc)
+                        if config.use_local_data_only:
+                            date = time.strftime('%Y-%m-%d')
+                            if date not in self.dates:
+                                self.dates.append(date)
+
+                        c = int(row[1])
+                        r = int(row[2])
+                        d = int(row[3])
+                        confirmed.append({
+                            'time': time,
+                            'count': c
+                        })
+                        recovered.append({
+                            'time': time,
+                            'count': r
+                        })
+                        deaths.append({
+                            'time': time,
+                            'count': d
+                        })
+
+                print(f'data confirmed: {admin2}, {province}, {country}, {c}')
+                print(f'data recovered: {admin2}, {province}, {country}, {r}')
+                print(f'data deaths   : {admin2}, {province}, {country}, {d}')
+
+                self.add_record({
+                    'country': country,
+                    'province': province,
+                    'admin2': admin2,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'confirmed': confirmed,
+                    'recovered': recovered,
+                    'deaths': deaths
+                })
+
+        if config.use_local_data_only:
+            self.dates.sort()
+            self.total_days = len(self.dates)
+
+        for country in self.has_duplicate_data:
+            if countries is not None and country not in countries:
+                continue
+            total_confirmed = total_recovered = total_deaths = 0
+            co_confirmed = co_recovered = co_deaths = 0
+            co_rec = None
+            last_updated = None
+            for rec in self.find_records(country):
+                province = rec['province']
+                confirmed = rec['confirmed']
+                recovered = rec['recovered']
+                deaths = rec['deaths']
+                index = len(confirmed) - 1
+                time = confirmed[index]['time']
+                c = confirmed[index]['count']
+                r = recovered[index]['count']
+                d = deaths[index]['count']
+                if province:
+                    if not last_updated or time > last_updated:
+                        last_updated = time
+                    total_confirmed += c
+                    total_recovered += r
+                    total_deaths += d
+                else:
+                    co_rec = rec
+                    co_last_updated = time
+                    co_confirmed = c
+                    co_recovered = r
+                    co_deaths = d
+
+            if co_confirmed == total_confirmed and \
+               co_recovered == total_recovered and \
+               co_deaths == total_deaths:
+                # remote data is exactly the same as local data
+                continue
+
+            index = len(co_rec['confirmed']) - 1
+            c = r = d = 0
+            if last_updated > co_last_updated:
+                # local data is newer
+                for category in ('confirmed', 'recovered', 'deaths'):
+                    replace_point(co_rec[category], index, time=last_updated)
+            else:
+                # remote data is newer
+                last_updated = co_last_updated
+
+            # be conservative!
+            if co_confirmed > total_confirmed:
+                c = co_confirmed - total_confirmed
+            elif total_confirmed > co_confirmed:
+                print(f'data confirmed: {country}, {co_confirmed} => '
+                        f'{total_confirmed}')
+                replace_point(co_rec['confirmed'], index,
+                              count=total_confirmed)
+            if co_recovered > total_recovered:
+                r = co_recovered - total_recovered
+            elif total_recovered > co_recovered:
+                print(f'data recovered: {country}, {co_recovered} => '
+                        f'{total_recovered}')
+                replace_point(co_rec['recovered'], index,
+                              count=total_recovered)
+            if co_deaths > total_deaths:
+                d = co_deaths - total_deaths
+            elif total_deaths > co_deaths:
+                print(f'data deaths   : {country}, {co_deaths} => '
+                        f'{total_deaths}')
+                replace_point(co_rec['deaths'], index,
+                              count=total_deaths)
+
+            if c + r + d == 0:
+                continue
+
+            province = 'Others'
+            latitude = co_rec['latitude']
+            longitude = co_rec['longitude']
+
+            print(f'data confirmed: {province}, {country}, {c}')
+            print(f'data recovered: {province}, {country}, {r}')
+            print(f'data deaths   : {province}, {country}, {d}')
+
+            confirmed = [{
+                'time': last_updated,
+                'count': c
+            }]
+            recovered = [{
+                'time': last_updated,
+                'count': r
+            }]
+            deaths = [{
+                'time': last_updated,
+                'count': d
+            }]
+            self.add_record({
                 'country': country,
                 'province': province,
                 'admin2': admin2,
-                'confirmed': rec['confirmed'],
-                'recovered': rec['recovered'],
-                'deaths': rec['deaths']
-            }
-        })
-        feature_id += 1
+                'latitude': latitude,
+                'longitude': longitude,
+                'confirmed': confirmed,
+                'recovered': recovered,
+                'deaths': deaths
+            })
 
-    # finally, build the output GeoJSON object and save it
-    geodata = {
-        'type': 'FeatureCollection',
-        'features': features
-    }
+    def validate_data(self, filename=anomalies_json):
+        # check all the series for cumulative counts decreasing or dropping to
+        # zero, children summing above their parents, and outlier jumps;
+        # repair them by config.repair_policy and write all the anomalies
+        policy = config.repair_policy
+        if policy not in (None, 'carry', 'backfill'):
+            raise Exception(f'{policy}: Unknown repair policy')
 
-    def convert_time(x):
-        if isinstance(x, datetime.datetime):
-            return int(x.timestamp())
-
-    with open(geodata_json, 'w') as f:
-        f.write(json.dumps(geodata, default=convert_time))
-
-def write_csv():
-    with open(data_csv, 'w') as f:
-        f.write('admin2,province,country,latitude,longitude,category')
-        for date in dates:
-            date = date.replace('-', '')
-            f.write(f',utc_{date}')
-        f.write('\n')
-        for rec in data:
+        print('Validating data...')
+
+        anomalies = []
+        for rec in self.data:
+            for category in ('confirmed', 'recovered', 'deaths'):
+                anomalies.extend(self.check_monotonic(rec, category, policy))
+        # children are monotonic now; raised parents are checked again
+        anomalies.extend(self.check_parents(policy))
+        for rec in self.data:
+            for category in ('confirmed', 'recovered', 'deaths'):
+                anomalies.extend(self.check_jumps(rec, category))
+
+        counts = {}
+        for anomaly in anomalies:
+            counts[anomaly['type']] = counts.get(anomaly['type'], 0) + 1
+        for anomaly_type, count in sorted(counts.items()):
+            print(f'Anomalies: {anomaly_type}, {count}')
+
+        write_file(filename, json.dumps({
+            'repair_policy': policy,
+            'counts': counts,
+            'anomalies': anomalies
+        }, indent=1))
+
+        print('Validating data completed')
+
+    def check_monotonic(self, rec, category, policy):
+        # days with counts below the maximum so far; carry keeps the maximum
+        # and backfill lowers earlier counts instead, but zero-filled gaps are
+        # always carried because zeros are missing data
+        series = rec[category]
+        counts = [x['count'] for x in series]
+        maxima = list(itertools.accumulate(counts, max))
+        anomalies = []
+        gaps = []
+        for start, end in find_runs([count < maximum for count, maximum in
+                                     zip(counts[1:], maxima)]):
+            start += 1
+            end += 1
+            run = counts[start:end + 1]
+            if not any(run):
+                gaps.append((start, end))
+            anomalies.append(create_anomaly(
+                'decrease' if any(run) else 'gap', rec, category,
+                series[start]['time'].strftime('%Y-%m-%d'),
+                series[end]['time'].strftime('%Y-%m-%d'),
+                expected=maxima[start], count=min(run),
+                repaired=policy is not None))
+
+        if anomalies and policy:
+            if policy == 'carry':
+                repaired = maxima
+            else:
+                repaired = list(counts)
+                for start, end in gaps:
+                    repaired[start:end + 1] = maxima[start:end + 1]
+                repaired = list(itertools.accumulate(reversed(repaired), min))
+                repaired.reverse()
+            for i, x in enumerate(series):
+                if repaired[i] != x['count']:
+                    # points can be shared between days
+                    series[i] = {'time': x['time'], 'count': repaired[i]}
+        return anomalies
+
+    def check_parents(self, policy):
+        # days when admin2 records in a province or provinces in a country add
+        # up to more than their parent record; parents are raised to the sum
+        # and checked for decreases again because raising some days can leave
+        # later days lower; provinces are reconciled before their countries
+        ordinals = self.get_date_ordinals()
+        anomalies = []
+        for provinces in self.locations.values():
+            families = [(admin2s.get(''),
+                         [rec for admin2, recs in admin2s.items() if admin2
+                              for rec in recs])
+                        for province, admin2s in provinces.items()]
+            families.append((provinces.get('', {}).get(''),
+                             [rec for province, admin2s in provinces.items()
+                                  if province
+                                  for rec in admin2s.get('', [])]))
+            for parents, children in families:
+                if not parents or not children:
+                    continue
+                parent = parents[0]
+                for category in ('confirmed', 'recovered', 'deaths'):
+                    series = parent[category]
+                    counts = self.align_series(series, ordinals)
+                    sums = [sum(x) for x in zip(*(
+                        self.align_series(rec[category], ordinals)
+                        for rec in children))]
+                    # only series with one point per day can be repaired
+                    repaired = policy is not None and \
+                               len(series) == self.total_days
+                    runs = find_runs([x > count
+                                      for x, count in zip(sums, counts)])
+                    for start, end in runs:
+                        anomalies.append(create_anomaly(
+                            'children_above_parent', parent, category,
+                            self.dates[start], self.dates[end],
+                            count=counts[start], children=sums[start],
+                            repaired=repaired))
+                        if repaired:
+                            for i in range(start, end + 1):
+                                series[i] = {'time': series[i]['time'],
+                                             'count': sums[i]}
+                    if repaired and runs:
+                        anomalies.extend(self.check_monotonic(
+                            parent, category, policy))
+        return anomalies
+
+    def check_jumps(self, rec, category):
+        # daily increases above anomaly_jump_factor times their average over
+        # the previous rolling_average_days days; these are only reported
+        series = rec[category]
+        average_days = config.rolling_average_days
+        increases = [x['count'] - y['count']
+                     for x, y in zip(series[1:], series)]
+        anomalies = []
+        for i, increase in enumerate(increases):
+            if i == 0 or increase < config.anomaly_jump_minimum:
+                continue
+            previous = increases[max(i - average_days, 0):i]
+            average = sum(previous) / len(previous)
+            if increase > config.anomaly_jump_factor * max(average, 1):
+                date = series[i + 1]['time'].strftime('%Y-%m-%d')
+                anomalies.append(create_anomaly(
+                    'jump', rec, category, date, date,
+                    previous=series[i]['count'], count=series[i + 1]['count'],
+                    average_increase=round(average, 1), repaired=False))
+        return anomalies
+
+    def sort_data(self):
+        # sort records by confirmed, country, and province
+        self.data.sort(key=lambda x: (
+            -x['confirmed'][len(x['confirmed'])-1]['count'],
+            x['country'],
+            x['province']))
+
+    def report_data(self):
+        total_confirmed = total_recovered = total_deaths = 0
+        for rec in self.data:
+            country = rec['country']
+            province = rec['province']
+            admin2 = rec['admin2']
+            latitude = rec['latitude']
+            longitude = rec['longitude']
+            index = len(rec['confirmed']) - 1
+            c = rec['confirmed'][index]['count']
+            r = rec['recovered'][index]['count']
+            d = rec['deaths'][index]['count']
+            if c + r + d == 0 or \
+               (country in self.has_duplicate_data and not province) or \
+               (country == 'United States' and not admin2):
+                continue
+            print(f'final: {admin2}, {province}, {country}, '
+                    f'{latitude}, {longitude}, {c}, {r}, {d}')
+            total_confirmed += c
+            total_recovered += r
+            total_deaths += d
+
+        print(f'Total confirmed: {total_confirmed}')
+        print(f'Total recovered: {total_recovered}')
+        print(f'Total deaths   : {total_deaths}')
+
+    def create_features(self, countries_to_display=None):
+        # create a new list to store all the features
+        features = []
+        # create a feature collection
+        feature_id = 0
+        for rec in self.data:
             country = rec['country']
             province = rec['province']
             admin2 = rec['admin2']
@@ -1232,40 +2396,438 @@ def write_csv():
             if (rec['confirmed'][index]['count'] +
                 rec['recovered'][index]['count'] +
                 rec['deaths'][index]['count'] == 0) or \
-               (has_countries_to_display and
-                country not in config.countries_to_display):
+               not is_country_to_display(country, countries_to_display):
                 continue
-            if ',' in admin2:
-                admin2 = f'"{admin2}"'
-            if ',' in province:
-                province = f'"{province}"'
-            if ',' in country:
-                country = f'"{country}"'
-            latitude = round(rec['latitude'], 4)
-            longitude = round(rec['longitude'], 4)
-            for category in ('confirmed', 'recovered', 'deaths'):
-                f.write(f'{admin2},{province},{country},{latitude},{longitude},'
-                        f'{category}')
-                i = 0
-                count = 0
-                for x in rec[category]:
-                    date = x['time'].strftime('%Y-%m-%d')
-                    while i < total_days - 1 and dates[i] < date:
-                        f.write(f',{count}')
-                        i += 1
-                    i += 1
-                    count = x['count']
-                    f.write(f',{count}')
-                while i < total_days:
-                    f.write(f',{count}')
-                    i += 1
-                f.write('\n')
+            features.append({
+                'id': feature_id,
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [
+                        round(rec['longitude'], 4),
+                        round(rec['latitude'], 4)
+                    ]
+                },
+                'properties': {
+                    'country': country,
+                    'province': province,
+                    'admin2': admin2,
+                    'confirmed': rec['confirmed'],
+                    'recovered': rec['recovered'],
+                    'deaths': rec['deaths']
+                }
+            })
+            feature_id += 1
+        return features
+
+    def write_geojson(self, filename=geodata_json, countries_to_display=None):
+        # finally, build the output GeoJSON object and save it
+        geodata = {
+            'type': 'FeatureCollection',
+            'features': self.create_features(countries_to_display)
+        }
+
+        if config.daily_history_days:
+            self.write_downsampled_geojson(filename, geodata,
+                                           default=convert_time)
+        else:
+            self.write_geojson_output(filename, json.dumps(
+                geodata, default=convert_time))
+        if config.binary_data:
+            self.write_output(get_binary_filename(filename),
+                              create_binary_data(geodata['features']))
+        if config.derived_metrics:
+            self.write_output(get_metrics_filename(filename), json.dumps(
+                create_derived_metrics(geodata['features'], None,
+                                       self.has_duplicate_data),
+                separators=(',', ':')))
+        if config.search_index:
+            self.write_output(get_search_index_filename(filename), json.dumps(
+                create_search_index(geodata['features']),
+                separators=(',', ':')))
+
+    def write_country_geojson(self, countries=None):
+        # write a smaller GeoJSON file for each single-country page with its own
+        # features only and precomputed country totals
+        for country, filename in config.country_geodata_json.items():
+            if countries is not None and country not in countries:
+                continue
+            features = self.create_features((country,))
+            if not features:
+                continue
+            geodata = {
+                'type': 'FeatureCollection',
+                'features': features,
+                'totals': calculate_country_totals(features,
+                                                   self.has_duplicate_data)
+            }
+
+            if config.daily_history_days:
+                self.write_downsampled_geojson(filename, geodata,
+                                               default=convert_time,
+                                               separators=(',', ':'))
+            else:
+                self.write_geojson_output(filename, json.dumps(geodata,
+                        default=convert_time, separators=(',', ':')))
+            if config.binary_data:
+                self.write_output(get_binary_filename(filename),
+                                  create_binary_data(features,
+                                                     geodata['totals']))
+            if config.derived_metrics:
+                self.write_output(get_metrics_filename(filename), json.dumps(
+                    create_derived_metrics(features, geodata['totals'],
+                                           self.has_duplicate_data),
+                    separators=(',', ':')))
+            if config.search_index:
+                self.write_output(get_search_index_filename(filename),
+                    json.dumps(create_search_index(features),
+                               separators=(',', ':')))
+
+    def write_downsampled_geojson(self, filename, geodata, **kwargs):
+        # write the full history to a separate file that clients can load
+        # later and keep only recent history at daily resolution
+        full_filename = get_full_filename(filename)
+        self.write_geojson_output(full_filename, json.dumps(geodata, **kwargs))
+        features, daily_start = downsample_features(
+                geodata['features'], config.daily_history_days)
+        geodata = dict(geodata, features=features, full=full_filename,
+                       daily_start=daily_start)
+        self.write_geojson_output(filename, json.dumps(geodata, **kwargs))
+
+    def write_csv(self, filename=data_csv, countries_to_display=None):
+        ordinals = self.get_date_ordinals()
+        with io.StringIO() as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(
+                ['admin2', 'province', 'country', 'latitude', 'longitude',
+                 'category'] +
+                [f'utc_{date.replace("-", "")}' for date in self.dates])
+            for rec in self.data:
+                country = rec['country']
+                index = len(rec['confirmed']) - 1
+                if (rec['confirmed'][index]['count'] +
+                    rec['recovered'][index]['count'] +
+                    rec['deaths'][index]['count'] == 0) or \
+                   not is_country_to_display(country, countries_to_display):
+                    continue
+                location = [rec['admin2'], rec['province'], country,
+                            round(rec['latitude'], 4),
+                            round(rec['longitude'], 4)]
+                writer.writerows(
+                    location + [category] +
+                    self.align_series(rec[category], ordinals)
+                    for category in ('confirmed', 'recovered', 'deaths'))
+
+            self.write_output(filename, f.getvalue())
+
+    def get_date_ordinals(self):
+        return [datetime.date.fromisoformat(x).toordinal() for x in self.dates]
+
+    def align_series(self, series, ordinals=None):
+        # counts on all the days in dates; days without data carry the last
+        # count forward; pass ordinals from get_date_ordinals() when aligning
+        # many series
+        if ordinals is None:
+            ordinals = self.get_date_ordinals()
+        last = self.total_days - 1
+        series_ordinals = [x['time'].toordinal() for x in series]
+        if series_ordinals:
+            # one count on each day from the first day
+            i = bisect.bisect_left(ordinals, series_ordinals[0], 0, last)
+            n = len(series_ordinals)
+            if i + n <= self.total_days and \
+               ordinals[i:i + n] == series_ordinals:
+                counts = [x['count'] for x in series]
+                return [0] * i + counts + \
+                       [counts[-1]] * (self.total_days - i - n)
+
+        counts = []
+        i = 0
+        count = 0
+        for x, ordinal in zip(series, series_ordinals):
+            j = bisect.bisect_left(ordinals, ordinal, i, last)
+            if j > i:
+                counts.extend([count] * (j - i))
+            i = j + 1
+            count = x['count']
+            counts.append(count)
+        if i < self.total_days:
+            counts.extend([count] * (self.total_days - i))
+        return counts
+
+    def write_columnar_data(self, filename=data_npz,
+                            long_filename=data_long_npz,
+                            countries_to_display=None):
+        # write the same data as write_csv() in NumPy's .npz format with typed
+        # columns; location names are dictionary-encoded as indices into
+        # admin2s, provinces, and countries
+        names = {'admin2': {}, 'province': {}, 'country': {}}
+        codes = {'admin2': [], 'province': [], 'country': []}
+        latitudes = array.array('d')
+        longitudes = array.array('d')
+        counts = {'confirmed': [], 'recovered': [], 'deaths': []}
+        ordinals = self.get_date_ordinals()
+        for rec in self.data:
+            country = rec['country']
+            index = len(rec['confirmed']) - 1
+            if (rec['confirmed'][index]['count'] +
+                rec['recovered'][index]['count'] +
+                rec['deaths'][index]['count'] == 0) or \
+               not is_country_to_display(country, countries_to_display):
+                continue
+            for field in ('admin2', 'province', 'country'):
+                codes[field].append(names[field].setdefault(
+                    rec[field], len(names[field])))
+            latitudes.append(round(rec['latitude'], 4))
+            longitudes.append(round(rec['longitude'], 4))
+            for category, x in counts.items():
+                x.extend(self.align_series(rec[category], ordinals))
+
+        n = len(latitudes)
+        days = self.total_days
+        # days since the epoch for datetime64[D]
+        epoch = datetime.date(1970, 1, 1)
+        dates = [(datetime.date.fromisoformat(x) - epoch).days
+                 for x in self.dates[:days]]
+        dictionaries = {
+            'admin2s': create_str_npy(list(names['admin2'])),
+            'provinces': create_str_npy(list(names['province'])),
+            'countries': create_str_npy(list(names['country']))
+        }
+
+        # one row per location and one column per day
+        arrays = dict(dictionaries)
+        arrays['dates'] = create_int_npy('q', '<M8[D]', dates)
+        for field in ('admin2', 'province', 'country'):
+            arrays[field] = create_int_npy('i', '<i4', codes[field])
+        arrays['latitude'] = create_int_npy('d', '<f8', latitudes)
+        arrays['longitude'] = create_int_npy('d', '<f8', longitudes)
+        for category, x in counts.items():
+            arrays[category] = create_int_npy('i', '<i4', x, (n, days))
+        # already compressed
+        self.write_output(filename, create_npz(arrays), compress=False)
+
+        # one row per location and day
+        arrays = dict(dictionaries)
+        for field in ('admin2', 'province', 'country'):
+            arrays[field] = create_int_npy('i', '<i4', (
+                code for code in codes[field] for i in range(days)))
+        arrays['date'] = create_int_npy('q', '<M8[D]', dates * n)
+        for category, x in counts.items():
+            arrays[category] = create_int_npy('i', '<i4', x)
+        self.write_output(long_filename, create_npz(arrays), compress=False)
+
+    def write_output(self, filename, content, compress=True):
+        # also write pre-compressed files that a static web server can serve
+        # directly, and remember the content hash so clients can cache by it
+        if isinstance(content, str):
+            content = content.encode()
+        changed = write_file(filename, content)
+        compress = compress and config.compress_outputs
+        if compress:
+            # don't compress unchanged content again
+            if changed or not os.path.exists(f'{filename}.gz'):
+                write_file(f'{filename}.gz',
+                           gzip.compress(content, compresslevel=9, mtime=0))
+            if brotli and (changed or not os.path.exists(f'{filename}.br')):
+                write_file(f'{filename}.br',
+                           brotli.compress(content, quality=11))
+        # remove stale compressed files that would be served instead
+        for ext in ('gz', 'br'):
+            if (not compress or not brotli and ext == 'br') \
+               and os.path.exists(f'{filename}.{ext}'):
+                remove_file(f'{filename}.{ext}')
+        self.output_hashes[filename] = hashlib.sha256(content).hexdigest()
+
+    def write_geojson_output(self, filename, content):
+        # write a delta from the previous version, named after its hash, so
+        # returning clients can update their cached data
+        if config.delta_days and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                old_content = f.read()
+            base = hashlib.sha256(old_content).hexdigest()
+            version = hashlib.sha256(content.encode()).hexdigest()
+            if base != version:
+                delta = create_geojson_delta(json.loads(old_content),
+                                             json.loads(content))
+                delta['base'] = base
+                delta['version'] = version
+                os.makedirs(deltas_dir, exist_ok=True)
+                write_file(f'{deltas_dir}/{base}.json',
+                           json.dumps(delta, separators=(',', ':')))
+
+            # remove old deltas
+            expired = time.time() - config.delta_days * 86400
+            for delta_json in glob.glob(f'{deltas_dir}/*.json'):
+                if os.path.getmtime(delta_json) < expired:
+                    remove_file(delta_json)
+
+        self.write_output(filename, content)
+
+    def write_output_hashes(self):
+        # merge with hashes from previous runs that wrote different outputs
+        hashes = {}
+        if os.path.exists(hashes_json):
+            with open(hashes_json) as f:
+                hashes = json.load(f)
+        hashes.update(self.output_hashes)
+        write_file(hashes_json, json.dumps(hashes))
+
+# local data sources that update files in the data folder
+local_data_fetchers = {
+    'kcdc': (fetch_kcdc_country, fetch_kcdc_provinces),
+    'dxy': (fetch_dxy,),
+    'statistichecoronavirus': (fetch_statistichecoronavirus,),
+    'minsal': (fetch_minsal,),
+}
+
+def get_local_data_state():
+    state = {}
+    for filename in glob.glob('data/*.csv'):
+        stat = os.stat(filename)
+        state[filename] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+def run_daemon(cycles=None, resume=False):
+    # keep fetched data, parsed daily reports, merged data, geocoded
+    # coordinates, and HTTP connections in memory and poll each data source on
+    # its own schedule; outputs are rebuilt only when some data has changed and
+    # errors are reported without stopping the daemon
+    countries_to_display = tuple(config.countries_to_display)
+    daily_dates = None
+    daily_cache = {}
+    features = None
+    next_poll = dict.fromkeys(config.refresh_intervals, 0)
+    next_daily_refresh = 0
+    merge_local = bool(local_data_fetchers.keys() &
+                       config.refresh_intervals.keys())
+    # CSSE data and the merged data with local data kept across cycles
+    base = merged = None
+    csse_pending = False
+    pending_countries = set()
+    cycle = 0
+    while True:
+        changed_files.clear()
+        removed_files.clear()
+        now = time.time()
+        csse_changed = False
+        changed_countries = set()
+        for source, interval in config.refresh_intervals.items():
+            if now < next_poll[source]:
+                continue
+            next_poll[source] = now + interval
+
+            print(f'Polling {source}...')
+            try:
+                if source == 'csse':
+                    if config.use_local_data_only:
+                        continue
+                    if config.daily_refresh_interval is not None and \
+                       now >= next_daily_refresh:
+                        # older daily reports can be corrected upstream;
+                        # parse all of them again as a one-shot run does
+                        next_daily_refresh = now + \
+                                config.daily_refresh_interval
+                        if daily_cache:
+                            daily_cache.clear()
+                            csse_changed = True
+                    dates = fetch_csse_daily_dates()
+                    # the latest daily report can be revised; always parse it
+                    latest = parse_csse_daily_csv(dates[0],
+                                                  countries_to_display)
+                    rest_features = fetch_all_features(features_url)
+                    if dates != daily_dates or \
+                       latest != daily_cache.get(dates[0]):
+                        csse_changed = True
+                        if daily_dates and daily_dates[0] != dates[0]:
+                            # the previous latest report can have been revised
+                            # since its last poll
+                            daily_cache.pop(daily_dates[0], None)
+                        daily_dates = dates
+                        daily_cache[dates[0]] = latest
+                    if rest_features != features:
+                        csse_changed = True
+                        features = rest_features
+                        save_rest_features(features)
+                else:
+                    state = get_local_data_state()
+                    for fetch in local_data_fetchers[source]:
+                        fetch()
+                    for filename, stat in get_local_data_state().items():
+                        if state.get(filename) != stat:
+                            key = filename.replace('data/', '').\
+                                    replace('.csv', '')
+                            changed_countries.add(read_key(key)[0])
+            except:
+                traceback.print_exc(file=sys.stdout)
+
+        # changes wait here until a rebuild succeeds
+        csse_pending |= csse_changed
+        pending_countries |= changed_countries
+        if (csse_pending or pending_countries) and \
+           (daily_dates or config.use_local_data_only):
+            try:
+                if csse_pending or not base:
+                    # merge all the CSSE data again, but only into base
+                    base = Pipeline(countries_to_display)
+                    if not config.use_local_data_only:
+                        base.fetch_csse_csv(daily_dates, daily_cache, resume)
+                        # only the first build resumes from checkpoints;
+                        # refreshes parse daily reports again
+                        resume = False
+                        base.fetch_csse_rest(features)
+                        base.clean_us_data()
+                    merged = base.copy()
+                    if config.use_local_data_only or merge_local:
+                        merged.merge_local_data()
+                    countries = None
+                else:
+                    # merge only the local data that has changed
+                    merged.restore_countries(base, pending_countries)
+                    merged.merge_local_data(pending_countries)
+                    countries = pending_countries
+                # validation and sorting change records; keep merged as is
+                pipeline = merged.copy()
+                if config.validate_data:
+                    pipeline.validate_data()
+                pipeline.sort_data()
+                pipeline.report_data()
+                pipeline.write_geojson()
+                pipeline.write_country_geojson(countries)
+                pipeline.write_csv()
+                if config.columnar_data:
+                    pipeline.write_columnar_data()
+                pipeline.write_output_hashes()
+                csse_pending = False
+                pending_countries = set()
+            except:
+                # try again in the next cycle; base is rebuilt if it failed
+                if csse_pending:
+                    base = None
+                traceback.print_exc(file=sys.stdout)
+        else:
+            print('No changes')
+        write_gazetteer()
+        write_manifest()
+        report_latencies()
+
+        cycle += 1
+        if cycles and cycle >= cycles:
+            break
+        time.sleep(max(min(next_poll.values()) - time.time(), 0))
 
 if __name__ == '__main__':
+    resume = '--resume' in sys.argv[1:]
+    if '--daemon' in sys.argv[1:]:
+        run_daemon(resume=resume)
+        sys.exit()
+
+    pipeline = Pipeline()
+
     if not config.use_local_data_only:
-        fetch_csse_csv()
-        fetch_csse_rest()
-        clean_us_data()
+        pipeline.fetch_csse_csv(resume=resume)
+        pipeline.fetch_csse_rest()
+        pipeline.clean_us_data()
 #        try:
 #            fetch_kcdc_country()
 #        except:
@@ -1287,10 +2849,19 @@ if __name__ == '__main__':
 #        except:
 #            traceback.print_exc(file=sys.stdout)
 #    try:
-#        merge_local_data()
+#        pipeline.merge_local_data()
 #    except:
 #        traceback.print_exc(file=sys.stdout)
-    sort_data()
-    report_data()
-    write_geojson()
-    write_csv()
+    if config.validate_data:
+        pipeline.validate_data()
+    pipeline.sort_data()
+    pipeline.report_data()
+    pipeline.write_geojson()
+    pipeline.write_country_geojson()
+    pipeline.write_csv()
+    if config.columnar_data:
+        pipeline.write_columnar_data()
+    pipeline.write_output_hashes()
+    write_gazetteer()
+    write_manifest()
+    report_latencies()
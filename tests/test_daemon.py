@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# run fetch_data.py --daemon against a local stand-in for the CSSE servers
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import functools
+import importlib.util
+import unittest
+import http.server
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+try:
+    import config
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+            'config', os.path.join(root, 'config-example.py'))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules['config'] = config
+import fetch_data
+
+daily_header = ('FIPS,Admin2,Province_State,Country_Region,Last_Update,Lat,'
+                'Long_,Confirmed,Deaths,Recovered,Active,Combined_Key\n')
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        self.served = os.path.join(self.dir, 'served')
+        self.work = os.path.join(self.dir, 'work')
+        os.makedirs(os.path.join(self.served, 'daily'))
+        os.makedirs(os.path.join(self.work, 'data'))
+        os.chdir(self.work)
+
+        handler = functools.partial(QuietHandler, directory=self.served)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{self.server.server_port}'
+
+        self.saved = {}
+        self.patch(fetch_data, ts_confirmed_url=f'{url}/ts.csv',
+                   daily_url_format=url + '/daily/{date}.csv',
+                   features_url=f'{url}/rest.json?f=json')
+        self.patch(config, use_local_data_only=False,
+                   countries_to_display=['Italy'],
+                   refresh_intervals={'csse': 0, 'test': 0},
+                   app_url='http://localhost', parse_processes=1,
+                   http_timeouts={'default': (5, 5)}, http_retries=0,
+                   http_backoff=0, hedge_delays={}, checkpoint_dir=None,
+                   compress_outputs=False, delta_days=0, binary_data=False,
+                   derived_metrics=False, daily_history_days=None,
+                   columnar_data=False, validate_data=False,
+                   search_index=False, rest_history_dir=None,
+                   country_geodata_json={}, daily_refresh_interval=None)
+        self.patch(fetch_data,
+                   local_data_fetchers={'test': (self.fetch_local,)})
+
+        self.dates = ['03-23-2020']
+        self.counts = {'03-23-2020': 10}
+        self.broken = set()
+        self.local_count = None
+        self.write_served()
+
+    def tearDown(self):
+        for (module, name), value in self.saved.items():
+            setattr(module, name, value)
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def patch(self, module, **values):
+        for name, value in values.items():
+            self.saved.setdefault((module, name), getattr(module, name, None))
+            setattr(module, name, value)
+
+    def write_served(self):
+        with open(os.path.join(self.served, 'ts.csv'), 'w') as f:
+            f.write('Province/State,Country/Region,Lat,Long,' +
+                    ','.join(f'{int(x[:2])}/{int(x[3:5])}/20'
+                             for x in sorted(self.dates)) + '\n')
+        for date in self.dates:
+            with open(os.path.join(self.served, 'daily', f'{date}.csv'),
+                      'w') as f:
+                if date in self.broken:
+                    f.write('Province/State,Country/Region\nx,y\n')
+                    continue
+                f.write(daily_header)
+                f.write(f',,Lombardia,Italy,{date},45.47,9.19,'
+                        f'{self.counts[date]},1,0,0,"Lombardia, Italy"\n')
+        with open(os.path.join(self.served, 'rest.json'), 'w') as f:
+            json.dump({'features': []}, f)
+
+    def fetch_local(self):
+        # a local data source that fails until it has data
+        if self.local_count is None:
+            raise Exception('Local data source failed')
+        fetch_data.write_file('data/Lombardia, Italy.csv',
+                              'time,confirmed,recovered,deaths\n'
+                              '2020-03-23 23:00:00+00:00,'
+                              f'{self.local_count},0,1\n')
+
+    def run_cycles(self, changes, get_counts=lambda x: x[-1]['count']):
+        # apply changes before each cycle and record whether geodata.json was
+        # rewritten, how many times CSSE data was merged, and the confirmed
+        # counts from get_counts()
+        results = []
+        merges = []
+        fetch_csse_csv = fetch_data.Pipeline.fetch_csse_csv
+        def count_merges(pipeline, *args, **kwargs):
+            merges.append(True)
+            return fetch_csse_csv(pipeline, *args, **kwargs)
+        self.patch(fetch_data.Pipeline, fetch_csse_csv=count_merges)
+
+        state = {'mtime': None, 'merges': 0}
+        def end_cycle():
+            mtime = os.stat(fetch_data.geodata_json).st_mtime_ns \
+                    if os.path.exists(fetch_data.geodata_json) else None
+            with open(fetch_data.geodata_json) as f:
+                features = json.load(f)['features']
+            results.append((mtime != state['mtime'],
+                            len(merges) - state['merges'],
+                            get_counts(features[0]['properties']['confirmed'])
+                            if features else None))
+            state['mtime'] = mtime
+            state['merges'] = len(merges)
+            if len(results) < len(changes):
+                changes[len(results)]()
+                self.write_served()
+        self.patch(fetch_data, report_latencies=end_cycle)
+
+        changes[0]()
+        fetch_data.run_daemon(cycles=len(changes))
+        return results
+
+    def test_daemon(self):
+        def nothing():
+            pass
+        def revise():
+            self.counts['03-23-2020'] = 20
+        def add_broken_dates():
+            self.dates = ['03-25-2020', '03-24-2020', '03-23-2020']
+            self.counts.update({'03-24-2020': 30, '03-25-2020': 40})
+            self.broken.add('03-24-2020')
+        def fix_broken_date():
+            self.broken.clear()
+        def fetch_local_data():
+            self.local_count = 50
+        def refetch_local_data():
+            self.local_count = 60
+
+        # each result: whether geodata.json was rewritten, the number of CSSE
+        # merges, and the last confirmed count
+        self.assertEqual(self.run_cycles([
+            nothing, nothing, revise, add_broken_dates, fix_broken_date,
+            fetch_local_data, refetch_local_data, nothing]), [
+            (True, 1, 10),
+            # unchanged sources don't rewrite outputs
+            (False, 0, 10),
+            (True, 1, 20),
+            # the rebuild fails, but the daemon keeps polling
+            (False, 1, 20),
+            (True, 1, 40),
+            # local data is merged without merging CSSE data again
+            (True, 0, 50),
+            (True, 0, 60),
+            (False, 0, 60),
+        ])
+
+    def test_revisions(self):
+        def nothing():
+            pass
+        def revise_and_add_date():
+            # revised after the last poll, but before the next date appeared
+            self.counts['03-23-2020'] = 15
+            self.dates = ['03-24-2020', '03-23-2020']
+            self.counts['03-24-2020'] = 30
+        def revise_old_date():
+            self.counts['03-23-2020'] = 17
+        def refresh():
+            self.patch(config, daily_refresh_interval=0)
+
+        # each result: whether geodata.json was rewritten, the number of CSSE
+        # merges, and the first two confirmed counts
+        self.assertEqual(self.run_cycles([
+            nothing, revise_and_add_date, revise_old_date, refresh, nothing],
+            lambda x: [y['count'] for y in x[:2]]), [
+            (True, 1, [10, 10]),
+            (True, 1, [15, 30]),
+            # cached reports are not parsed again
+            (False, 0, [15, 30]),
+            # until all of them are refreshed
+            (True, 1, [17, 30]),
+            (False, 1, [17, 30]),
+        ])
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        fetch_data.changed_files.clear()
+        fetch_data.removed_files.clear()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def run_once(self, write=(), remove=()):
+        fetch_data.changed_files.clear()
+        fetch_data.removed_files.clear()
+        for filename in write:
+            fetch_data.write_file(filename, filename + str(len(write)))
+        for filename in remove:
+            fetch_data.remove_file(filename)
+        fetch_data.write_manifest()
+        if not os.path.exists(fetch_data.manifest_json):
+            return None
+        with open(fetch_data.manifest_json) as f:
+            manifest = json.load(f)
+        return sorted(manifest['changed']), manifest['removed']
+
+    def test_manifest(self):
+        self.assertEqual(self.run_once(write=['a', 'b']), (['a', 'b'], []))
+        # runs without changes keep earlier changes
+        self.assertEqual(self.run_once(), (['a', 'b'], []))
+        self.assertEqual(self.run_once(write=['c'], remove=['a']),
+                         (['b', 'c'], ['a']))
+        self.assertEqual(self.run_once(write=['a']), (['a', 'b', 'c'], []))
+        # deployment consumes the manifest by deleting it
+        os.remove(fetch_data.manifest_json)
+        self.assertEqual(self.run_once(), None)
+        self.assertEqual(self.run_once(remove=['b']), ([], ['b']))
+
+    def test_compressed_outputs(self):
+        compress_outputs = config.compress_outputs
+        brotli = fetch_data.brotli
+        pipeline = fetch_data.Pipeline()
+        try:
+            config.compress_outputs = True
+            pipeline.write_output('a', 'a')
+            self.assertTrue(os.path.exists('a.gz'))
+            # compressed files left by earlier runs are removed once they
+            # can't be updated
+            open('a.br', 'w').close()
+            fetch_data.brotli = None
+            pipeline.write_output('a', 'b')
+            self.assertFalse(os.path.exists('a.br'))
+            config.compress_outputs = False
+            pipeline.write_output('a', 'c')
+            self.assertFalse(os.path.exists('a.gz'))
+            self.assertEqual(fetch_data.removed_files, ['a.br', 'a.gz'])
+        finally:
+            config.compress_outputs = compress_outputs
+            fetch_data.brotli = brotli
+
+if __name__ == '__main__':
+    unittest.main()
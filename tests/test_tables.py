@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# parse saved pages of national data sources with their table columns
+import os
+import io
+import sys
+import csv
+import shutil
+import tempfile
+import contextlib
+import importlib.util
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+try:
+    import config
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+            'config', os.path.join(root, 'config-example.py'))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules['config'] = config
+import fetch_data
+
+pages_dir = os.path.join(root, 'tests', 'pages')
+
+class Response:
+    def __init__(self, filename):
+        with open(os.path.join(pages_dir, filename), 'rb') as f:
+            self.content = f.read()
+
+class TablesTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'data'))
+        os.chdir(self.dir)
+        self.http_get = fetch_data.http_get
+
+    def tearDown(self):
+        fetch_data.http_get = self.http_get
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def fetch(self, fetch, filename):
+        fetch_data.http_get = lambda source, url, **kwargs: Response(filename)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            fetch()
+        return out.getvalue()
+
+    def read_last_row(self, country, province=None):
+        with open(fetch_data.get_data_filename(country, province)) as f:
+            return list(csv.reader(f))[-1][1:]
+
+    def test_kcdc_provinces(self):
+        self.fetch(fetch_data.fetch_kcdc_provinces, 'kcdc-provinces.html')
+        # confirmed, not the daily increase whose header also contains 확진환자
+        self.assertEqual(self.read_last_row('South Korea', 'Seoul'),
+                         ['555', '144', '0'])
+        self.assertEqual(self.read_last_row('South Korea', 'Daegu'),
+                         ['6781', '4630', '119'])
+
+    def test_statistichecoronavirus(self):
+        self.fetch(fetch_data.fetch_statistichecoronavirus,
+                   'statistichecoronavirus.html')
+        self.assertEqual(self.read_last_row('Italy', 'Lombardia'),
+                         ['49118', '14498', '8905'])
+        self.assertEqual(self.read_last_row('Italy', 'Veneto'),
+                         ['11588', '1695', '612'])
+
+    def test_minsal(self):
+        self.fetch(fetch_data.fetch_minsal, 'minsal.html')
+        self.assertEqual(self.read_last_row('Chile', 'Metropolitana'),
+                         ['2922', '0', '14'])
+        self.assertEqual(self.read_last_row('Chile', 'OHiggins'),
+                         ['64', '0', '0'])
+        self.assertEqual(self.read_last_row('Chile'), ['4815', '528', '37'])
+
+    def test_missing_headers(self):
+        # a changed layout names the headers that are no longer found
+        fetch_data.http_get = lambda source, url, **kwargs: \
+                Response('minsal.html')
+        columns = fetch_data.minsal_columns
+        fetch_data.minsal_columns = dict(columns, deaths='Muertes',
+                                         recovered='Recuperados')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                with self.assertRaises(Exception):
+                    fetch_data.fetch_minsal()
+        finally:
+            fetch_data.minsal_columns = columns
+        self.assertIn('Warning: no minsal table with headers: Muertes, '
+                      'Recuperados', out.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# compare totals from fetch_data.py with those that covid-19-worker.js adds up
+import os
+import sys
+import json
+import shutil
+import datetime
+import tempfile
+import subprocess
+import importlib.util
+import unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+try:
+    import config
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+            'config', os.path.join(root, 'config-example.py'))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules['config'] = config
+import fetch_data
+
+# load geodata.json in the worker and print the increases of its statistics
+worker_js = '''
+const fs = require('fs');
+const vm = require('vm');
+const [root, dir, hasDuplicateData] = process.argv.slice(1);
+class XMLHttpRequest {
+	open(method, url){
+		this.url = url.split('?')[0];
+	}
+	send(){
+		setTimeout(() => {
+			const filename = dir + '/' + this.url;
+			this.status = fs.existsSync(filename) ? 200 : 404;
+			this.response = this.status == 200 ?
+				JSON.parse(fs.readFileSync(filename)) : null;
+			this.onload();
+		});
+	}
+}
+const context = vm.createContext({XMLHttpRequest, console, setTimeout});
+context.postMessage = message => {
+	const increase = counts =>
+		counts.map((x, i) => x - (i ? counts[i - 1] : 0));
+	const stats = message.stats;
+	const countries = {};
+	Object.entries(stats.statsByCountry).forEach(([country, s]) => {
+		countries[country] = increase(s.confirmed);
+	});
+	console.log(JSON.stringify({
+		countries: countries,
+		total: stats.confirmedIncrease
+	}));
+};
+vm.runInContext(fs.readFileSync(root + '/covid-19-worker.js', 'utf8'),
+	context);
+context.onmessage({data: {
+	type: 'load',
+	dataUrl: 'geodata.json',
+	countryToDisplay: null,
+	hasDuplicateData: JSON.parse(hasDuplicateData),
+	averageDaysFromConfirmedToDeath: 14
+}});
+'''
+
+def create_feature(feature_id, country, province, admin2, start, counts):
+    first_day = datetime.datetime(2020, 3, 1, 23, 59, 59,
+                                  tzinfo=datetime.timezone.utc)
+    series = [{
+        'time': first_day + datetime.timedelta(days=start + i),
+        'count': count
+    } for i, count in enumerate(counts)]
+    return {
+        'id': feature_id,
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [0, 0]},
+        'properties': {
+            'country': country,
+            'province': province,
+            'admin2': admin2,
+            'confirmed': series,
+            'recovered': [dict(x, count=0) for x in series],
+            'deaths': [dict(x, count=0) for x in series]
+        }
+    }
+
+class TotalsTest(unittest.TestCase):
+    def setUp(self):
+        self.has_duplicate_data = ['Chile']
+        self.features = [create_feature(*x) for x in (
+            (0, 'France', '', '', 0, [10, 20, 30]),
+            (1, 'France', 'Guadeloupe', '', 0, [5, 6, 7]),
+            (2, 'Chile', '', '', 0, [9, 19, 29]),
+            (3, 'Chile', 'Santiago', '', 0, [4, 8, 12]),
+            (4, 'Chile', 'Valparaiso', '', 1, [2, 3]),
+            (5, 'United States', '', '', 0, [50, 60, 70]),
+            (6, 'United States', 'Illinois', '', 0, [40, 50, 60]),
+            (7, 'United States', 'Illinois', 'Cook', 0, [30, 40]),
+            (8, 'United States', 'Illinois', 'Lake', 1, [1, 2]))]
+
+    def test_derived_metrics(self):
+        metrics = fetch_data.create_derived_metrics(
+                self.features, None, self.has_duplicate_data)
+        increases = {country: x['increase']['confirmed']
+                     for country, x in metrics['countries'].items()}
+        # overseas provinces are added to the country-wide record; provinces
+        # and admin2 records replace it in countries with duplicate data and
+        # in the United States
+        self.assertEqual(increases, {
+            'France': [15, 11, 11],
+            'Chile': [4, 6, 5],
+            'United States': [30, 11, 1]
+        })
+        self.assertEqual(metrics['total']['increase']['confirmed'],
+                         [49, 28, 17])
+
+        totals = fetch_data.calculate_country_totals(
+                self.features[:2], self.has_duplicate_data)
+        self.assertEqual(totals['confirmed'], [15, 26, 37])
+
+    @unittest.skipUnless(shutil.which('node'), 'requires node')
+    def test_client_totals(self):
+        metrics = fetch_data.create_derived_metrics(
+                self.features, None, self.has_duplicate_data)
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'geodata.json'), 'w') as f:
+                json.dump({
+                    'type': 'FeatureCollection',
+                    'features': self.features
+                }, f, default=fetch_data.convert_time)
+            stats = json.loads(subprocess.run(
+                ['node', '-e', worker_js, root, tmp,
+                 json.dumps(self.has_duplicate_data)],
+                check=True, capture_output=True, text=True).stdout)
+
+        self.assertEqual(stats['countries'], {
+            country: x['increase']['confirmed']
+            for country, x in metrics['countries'].items()})
+        self.assertEqual(stats['total'],
+                         metrics['total']['increase']['confirmed'])
+
+if __name__ == '__main__':
+    unittest.main()